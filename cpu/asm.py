@@ -0,0 +1,307 @@
+#!/usr/bin/python3
+
+# RV32I assembler. Program builds code one instruction at a time from
+# isa.INSTR (through isa.encode()); branch and jump targets can be labels,
+# which are resolved in a second pass once the code is complete.
+# assemble() drives a Program from GNU-style assembly text:
+#
+#   loop:   addi  a0, a0, -1        # comments start with #
+#           lw    t0, 8(sp)
+#           bnez  a0, loop
+#
+# with the usual pseudo-instructions (li, la, mv, j, call, ret, beqz, ...)
+# and the directives .word, .space and .align. Numeric branch and jump
+# operands are byte offsets. The image can go straight into memory with
+# load(), so generated programs never need a toolchain.
+#
+#   ./asm.py prog.s [-o prog.bin] [--base ADDR] [--run]
+
+import argparse
+import sys
+
+import isa
+
+BASE = 0x80000000
+MASK = 0xFFFFFFFF
+
+# register names: x0-x31, the ABI names, zero and fp
+REGS = {"x%d" % i: i for i in range(32)}
+REGS.update((name, i) for i, name in enumerate(isa.regnames[:32]))
+REGS.update({"zero": 0, "fp": 8})
+CSR_NUMBERS = {name: csr for csr, name in isa.CSRS.items()}
+
+
+def lo12(value):
+    # low 12 bits as the sign-extended immediate of an addi
+    return ((value & 0xfff) ^ 0x800) - 0x800
+
+
+class Program:
+    # code as a list of words, with labels resolved when the image is made
+
+    def __init__(self, base=BASE):
+        self.base = base
+        self.code = []
+        self.labels = {}
+        # (index, name, rd, rs1, rs2, label, part, where); part is None for
+        # a branch or jump offset, "hi"/"lo" for the auipc/addi of la
+        self.fixups = []
+        # where the code being added comes from, for errors in image();
+        # assemble() sets it to the source line
+        self.where = None
+
+    def pc(self):
+        return self.base + 4 * len(self.code)
+
+    def label(self, name):
+        if (name in self.labels):
+            raise Exception("label %s defined twice" % name)
+        self.labels[name] = self.pc()
+
+    def op(self, name, rd=0, rs1=0, rs2=0, imm=0, target=None, part=None):
+        if (target is not None):
+            self.fixups.append((len(self.code), name, rd, rs1, rs2, target, part, self.where))
+        self.code.append(isa.encode(name, rd, rs1, rs2, imm))
+
+    def word(self, value):
+        self.code.append(value & MASK)
+
+    def li(self, rd, value):
+        # addi when value fits in 12 bits, otherwise lui + addi with the
+        # addi's sign folded into the upper part
+        value &= MASK
+        lo = lo12(value)
+        if (value == lo & MASK):
+            self.op("addi", rd, 0, imm=lo)
+            return
+        self.op("lui", rd, imm=(value - lo) & MASK)
+        if (lo):
+            self.op("addi", rd, rd, imm=lo)
+
+    def la(self, rd, target):
+        # auipc + addi of a label's address
+        self.op("auipc", rd, target=target, part="hi")
+        self.op("addi", rd, rd, target=target, part="lo")
+
+    def exit(self):
+        # how riscv-tests pass: gp = 1; ecall, then a zero word to halt
+        self.op("addi", isa.regnames.index("gp"), 0, imm=1)
+        self.op("ecall")
+        self.code.append(0)
+
+    def image(self):
+        for i, name, rd, rs1, rs2, target, part, where in self.fixups:
+            try:
+                if (target not in self.labels):
+                    raise Exception("undefined label %s" % target)
+                pc = self.base + 4 * i
+                if (part == "hi"):
+                    off = self.labels[target] - pc
+                    imm = (off - lo12(off)) & MASK
+                elif (part == "lo"):
+                    imm = lo12(self.labels[target] - (pc - 4))
+                else:
+                    imm = self.labels[target] - pc
+                self.code[i] = isa.encode(name, rd, rs1, rs2, imm)
+            except Exception as e:
+                if (where is None):
+                    raise
+                raise Exception("%s: %s" % (where, e))
+        return b"".join(w.to_bytes(4, "little") for w in self.code)
+
+
+# *** Text ***
+
+def reg(s):
+    if (s not in REGS):
+        raise Exception("bad register %s" % s)
+    return REGS[s]
+
+
+def number(s):
+    return int(s, 0)
+
+
+def csr(s):
+    return CSR_NUMBERS[s] if s in CSR_NUMBERS else number(s)
+
+
+def memory(s):
+    # "imm(reg)" -> (imm, reg)
+    imm, _, rest = s.partition("(")
+    if (not rest.endswith(")")):
+        raise Exception("bad memory operand %s" % s)
+    return number(imm) if imm.strip() else 0, reg(rest[:-1].strip())
+
+
+def branch(p, name, rs1, rs2, target):
+    # target is a label or a byte offset
+    try:
+        p.op(name, rs1=rs1, rs2=rs2, imm=number(target))
+    except ValueError:
+        p.op(name, rs1=rs1, rs2=rs2, target=target)
+
+
+def jump(p, rd, target):
+    try:
+        p.op("jal", rd, imm=number(target))
+    except ValueError:
+        p.op("jal", rd, target=target)
+
+
+# pseudo-instruction -> function(program, operands)
+PSEUDO = {
+    "nop": lambda p: p.op("addi"),
+    "li": lambda p, rd, imm: p.li(reg(rd), number(imm)),
+    "la": lambda p, rd, target: p.la(reg(rd), target),
+    "mv": lambda p, rd, rs: p.op("addi", reg(rd), reg(rs)),
+    "not": lambda p, rd, rs: p.op("xori", reg(rd), reg(rs), imm=-1),
+    "neg": lambda p, rd, rs: p.op("sub", reg(rd), 0, reg(rs)),
+    "seqz": lambda p, rd, rs: p.op("sltiu", reg(rd), reg(rs), imm=1),
+    "snez": lambda p, rd, rs: p.op("sltu", reg(rd), 0, reg(rs)),
+    "sltz": lambda p, rd, rs: p.op("slt", reg(rd), reg(rs), 0),
+    "sgtz": lambda p, rd, rs: p.op("slt", reg(rd), 0, reg(rs)),
+    "j": lambda p, target: jump(p, 0, target),
+    "call": lambda p, target: jump(p, 1, target),
+    "jr": lambda p, rs: p.op("jalr", 0, reg(rs)),
+    "ret": lambda p: p.op("jalr", 0, 1),
+    "beqz": lambda p, rs, target: branch(p, "beq", reg(rs), 0, target),
+    "bnez": lambda p, rs, target: branch(p, "bne", reg(rs), 0, target),
+    "bltz": lambda p, rs, target: branch(p, "blt", reg(rs), 0, target),
+    "bgez": lambda p, rs, target: branch(p, "bge", reg(rs), 0, target),
+    "blez": lambda p, rs, target: branch(p, "bge", 0, reg(rs), target),
+    "bgtz": lambda p, rs, target: branch(p, "blt", 0, reg(rs), target),
+    "bgt": lambda p, a, b, target: branch(p, "blt", reg(b), reg(a), target),
+    "ble": lambda p, a, b, target: branch(p, "bge", reg(b), reg(a), target),
+    "bgtu": lambda p, a, b, target: branch(p, "bltu", reg(b), reg(a), target),
+    "bleu": lambda p, a, b, target: branch(p, "bgeu", reg(b), reg(a), target),
+    "csrr": lambda p, rd, c: p.op("csrrs", reg(rd), 0, imm=csr(c)),
+    "csrw": lambda p, c, rs: p.op("csrrw", 0, reg(rs), imm=csr(c)),
+    "csrs": lambda p, c, rs: p.op("csrrs", 0, reg(rs), imm=csr(c)),
+    "csrc": lambda p, c, rs: p.op("csrrc", 0, reg(rs), imm=csr(c)),
+}
+
+
+def directive(p, name, args):
+    if (name == ".word"):
+        for a in args:
+            p.word(number(a))
+    elif (name == ".space"):
+        n = number(args[0])
+        if (n & 3):
+            raise Exception(".space must be a multiple of 4")
+        p.code += [0] * (n >> 2)
+    elif (name == ".align"):
+        # to 2**n bytes, as GNU as does for RISC-V
+        while (p.pc() & ((1 << number(args[0])) - 1)):
+            p.code.append(0)
+    elif (name not in (".text", ".globl", ".global", ".section")):
+        raise Exception("unknown directive %s" % name)
+
+
+def instruction(p, name, args):
+    if (name.startswith(".")):
+        return directive(p, name, args)
+    if (name in PSEUDO):
+        return PSEUDO[name](p, *args)
+    if (name not in isa.INSTR):
+        raise Exception("unknown instruction %s" % name)
+    t = isa.INSTR[name]["type"]
+    if (name in ("ecall", "ebreak", "mret", "fence", "fence.i")):
+        # fence's predecessor/successor sets are ignored
+        p.op(name)
+    elif (name.startswith("csr")):
+        rd, c, src = args
+        # csr*i take the immediate in the rs1 field
+        p.op(name, reg(rd), number(src) if name.endswith("i") else reg(src), imm=csr(c))
+    elif (name == "jalr"):
+        if (len(args) == 1):
+            p.op(name, 1, reg(args[0]))
+        elif (len(args) == 2):
+            imm, rs1 = memory(args[1]) if "(" in args[1] else (0, reg(args[1]))
+            p.op(name, reg(args[0]), rs1, imm=imm)
+        else:
+            p.op(name, reg(args[0]), reg(args[1]), imm=number(args[2]))
+    elif (name in isa.LOADS):
+        imm, rs1 = memory(args[1])
+        p.op(name, reg(args[0]), rs1, imm=imm)
+    elif (t == "S"):
+        imm, rs1 = memory(args[1])
+        p.op(name, rs1=rs1, rs2=reg(args[0]), imm=imm)
+    elif (t == "R"):
+        p.op(name, reg(args[0]), reg(args[1]), reg(args[2]))
+    elif (t == "I"):
+        p.op(name, reg(args[0]), reg(args[1]), imm=number(args[2]))
+    elif (t == "B"):
+        branch(p, name, reg(args[0]), reg(args[1]), args[2])
+    elif (t == "U"):
+        # the operand is the upper 20 bits
+        p.op(name, reg(args[0]), imm=number(args[1]) << 12)
+    elif (t == "J"):
+        if (len(args) == 1):
+            jump(p, 1, args[0])
+        else:
+            jump(p, reg(args[0]), args[1])
+
+
+def assemble(source, base=BASE):
+    # Program for assembly text; call image() for the code
+    p = Program(base)
+    for lineno, line in enumerate(source.splitlines(), 1):
+        text = line.split("#", 1)[0].strip()
+        p.where = "line %d: %s" % (lineno, line.strip())
+        try:
+            while (":" in text):
+                name, text = text.split(":", 1)
+                p.label(name.strip())
+                text = text.strip()
+            if (not text):
+                continue
+            name, *rest = text.split(None, 1)
+            args = [a.strip() for a in rest[0].split(",")] if rest else []
+            instruction(p, name.lower(), args)
+        except Exception as e:
+            raise Exception("%s: %s" % (p.where, e))
+    p.where = None
+    return p
+
+
+def load(m, source, base=BASE):
+    # assemble into anything with load(addr, data) (Machine, Memory,
+    # batch.Batch); returns the labels
+    p = assemble(source, base)
+    m.load(base, p.image())
+    return p.labels
+
+
+def main():
+    parser = argparse.ArgumentParser(description="assemble RV32I")
+    parser.add_argument("source")
+    parser.add_argument("-o", "--output", help="write the raw image here")
+    parser.add_argument("--base", type=lambda x: int(x, 0), default=BASE, help="address of the first instruction")
+    parser.add_argument("--run", action="store_true", help="run the image in cpu1 and dump the registers")
+    args = parser.parse_args()
+
+    with open(args.source) as f:
+        p = assemble(f.read(), args.base)
+    image = p.image()
+    if (args.output):
+        with open(args.output, "wb") as f:
+            f.write(image)
+    if (args.run):
+        import cpu1
+        m = cpu1.Machine()
+        m.load(args.base, image)
+        m.regs[cpu1.PC] = args.base
+        print(m.run(10000000))
+        m.dump()
+    elif (not args.output):
+        import disasm
+        for i in range(0, len(image), 4):
+            word = int.from_bytes(image[i:i + 4], "little")
+            print("%8x:\t%08x\t%s" % (args.base + i, word, disasm.disasm(word, args.base + i)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
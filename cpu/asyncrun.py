@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+
+# asyncio front end. Each guest is a Session that runs its machine in
+# slices of N instructions and yields to the event loop in between, so one
+# host process can drive many guests, and their consoles, without threads
+# or blocking reads. The guest UART (at cpu1.UART_BASE) is connected to an
+# asyncio stream: stdin/stdout, a pty, or one TCP connection per guest.
+# A session can be paused and resumed, and stops when its task is
+# cancelled or the guest stops (see Machine.run()).
+#
+#   ./asyncrun.py prog.elf                      console on stdin/stdout
+#   ./asyncrun.py --pty prog.elf                console on a new pty
+#   ./asyncrun.py --tcp 127.0.0.1:7000 prog.elf a new guest per connection
+
+import argparse
+import asyncio
+import os
+import sys
+import tty
+
+import cpu1
+from memory import PAGE_SIZE
+from uart import UART
+
+# instructions per slice
+SLICE = 10000
+
+
+class StreamOut:
+    # UART.out for an asyncio StreamWriter; writes are buffered by the
+    # transport, Session.run() drains it after every slice
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write(self, data):
+        self.writer.write(bytes(data))
+
+    def flush(self):
+        pass
+
+
+class Session:
+    def __init__(self, machine, reader=None, writer=None, slice=SLICE):
+        self.machine = machine
+        self.reader = reader
+        self.writer = writer
+        self.slice = slice
+        self.uart = UART(StreamOut(writer) if writer is not None else None)
+        machine.memory.attach(cpu1.UART_BASE, PAGE_SIZE, self.uart)
+        # set while the session may run
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+        self.instructions = 0
+
+    def pause(self):
+        self.resumed.clear()
+
+    def resume(self):
+        self.resumed.set()
+
+    async def pump(self):
+        # guest console input
+        while True:
+            data = await self.reader.read(4096)
+            if (not data):
+                return
+            self.uart.feed(data)
+
+    async def run(self):
+        # returns the instructions executed once the guest halts
+        pump = asyncio.ensure_future(self.pump()) if self.reader is not None else None
+        m = self.machine
+        try:
+            while True:
+                await self.resumed.wait()
+                result = m.run(self.slice)
+                self.instructions += result.instructions
+                self.uart.flush()
+                if (self.writer is not None):
+                    await self.writer.drain()
+                if (result.reason == cpu1.FAULT):
+                    raise result.error
+                if (result.reason != cpu1.LIMIT):
+                    return self.instructions
+                await asyncio.sleep(0)
+        finally:
+            self.uart.flush()
+            if (pump is not None):
+                pump.cancel()
+
+
+def machine(path):
+    m = cpu1.Machine()
+    with open(path, "rb") as f:
+        m.load_elf(f)
+    return m
+
+
+async def pipes(rfd, wfd):
+    # StreamReader/StreamWriter over a pipe or tty pair of file descriptors
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(rfd, "rb", 0))
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin,
+                                                        os.fdopen(wfd, "wb", 0))
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer
+
+
+async def serve_tcp(path, host, port, slice):
+    async def connected(reader, writer):
+        try:
+            await Session(machine(path), reader, writer, slice).run()
+        except Exception as e:
+            print("%s: %s: %s" % (writer.get_extra_info("peername"), type(e).__name__, e), file=sys.stderr)
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(connected, host, port)
+    print("serving %s on %s" % (path, ", ".join(str(s.getsockname()) for s in server.sockets)))
+    async with server:
+        await server.serve_forever()
+
+
+async def serve_pty(path, slice):
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    print("console on %s" % os.ttyname(slave))
+    reader, writer = await pipes(master, os.dup(master))
+    return await Session(machine(path), reader, writer, slice).run()
+
+
+async def serve_stdio(path, slice):
+    reader, writer = await pipes(os.dup(sys.stdin.fileno()), os.dup(sys.stdout.fileno()))
+    return await Session(machine(path), reader, writer, slice).run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="run a guest with its console on a stream")
+    parser.add_argument("elf")
+    parser.add_argument("--slice", type=int, default=SLICE, help="instructions between event loop turns")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--pty", action="store_true", help="put the console on a new pty")
+    group.add_argument("--tcp", metavar="HOST:PORT", help="start a guest per TCP connection")
+    args = parser.parse_args()
+
+    if (args.tcp):
+        host, port = args.tcp.rsplit(":", 1)
+        coro = serve_tcp(args.elf, host, int(port), args.slice)
+    elif (args.pty):
+        coro = serve_pty(args.elf, args.slice)
+    else:
+        coro = serve_stdio(args.elf, args.slice)
+    try:
+        asyncio.run(coro)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
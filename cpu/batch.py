@@ -0,0 +1,383 @@
+#!/usr/bin/python3
+
+# Batch engine: N independent RV32I harts running the same program in
+# lockstep, for fuzzing and parameter sweeps. Registers are a NumPy uint32
+# array of shape (N, 32) and memories one uint8 array of shape (N, pages *
+# 4 KB), so every step costs a handful of vector operations whatever N is.
+#
+# Each step groups the running harts by pc, decodes once per pc (from the
+# first hart there: harts are expected to run the same code) and applies
+# the instruction to the whole group as masked vector operations. Branches
+# just give every hart its own next pc; the groups split and merge again
+# on their own. A store to a page holding decoded code drops all of it.
+#
+# Memory is the same sparse 4 KB pages for every hart, allocated (zeroed)
+# for all harts the first time any hart touches a page, up to MEMORY bytes
+# in total. Column offsets of the pages follow their addresses, so
+# accesses that cross into the next page stay contiguous.
+#
+# A hart stops in front of ecall or ebreak, at a zero word, or with a fault
+# (illegal or unsupported instruction such as CSR accesses, out of memory);
+# the others go on. Needs NumPy, unlike the rest of the emulator.
+#
+#   ./batch.py [-n HARTS] [--steps N] prog.elf
+#   ./batch.py [-n HARTS] -w WORKLOAD           one of bench.py's workloads
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import cpu1
+import elf
+from memory import PAGE_SHIFT, PAGE_SIZE, PAGE_MASK
+
+MASK = 0xFFFFFFFF
+# total bytes of memory, over all harts
+MEMORY = 1 << 30
+
+# hart status
+RUNNING, ECALL, EBREAK, HALT, FAULT = range(5)
+STATUS = ["running", "ecall", "ebreak", "halt", "fault"]
+
+
+class Op:
+    # a decoded instruction with its immediate as a NumPy scalar
+    __slots__ = ("pc", "next", "name", "fn", "rd", "rs1", "rs2", "imm")
+
+    def __init__(self, d, fn):
+        self.pc = d.pc
+        self.next = np.uint32((d.pc + 4) & MASK)
+        self.name = d.name
+        self.fn = fn
+        self.rd = d.rd
+        self.rs1 = d.rs1
+        self.rs2 = d.rs2
+        self.imm = np.uint32(d.imm & MASK)
+
+
+def signed(x):
+    return x.view(np.int32)
+
+
+ALU = {
+    "add": lambda x, y: x + y,
+    "sub": lambda x, y: x - y,
+    "sll": lambda x, y: x << (y & 31),
+    "slt": lambda x, y: (signed(x) < signed(y)).astype(np.uint32),
+    "sltu": lambda x, y: (x < y).astype(np.uint32),
+    "xor": lambda x, y: x ^ y,
+    "srl": lambda x, y: x >> (y & 31),
+    "sra": lambda x, y: (signed(x) >> (y & 31).astype(np.int32)).view(np.uint32),
+    "or": lambda x, y: x | y,
+    "and": lambda x, y: x & y,
+}
+ALU_IMM = {"addi": "add", "slti": "slt", "sltiu": "sltu", "xori": "xor", "ori": "or", "andi": "and",
+           "slli": "sll", "srli": "srl", "srai": "sra"}
+BRANCH = {
+    "beq": lambda x, y: x == y,
+    "bne": lambda x, y: x != y,
+    "blt": lambda x, y: signed(x) < signed(y),
+    "bge": lambda x, y: signed(x) >= signed(y),
+    "bltu": lambda x, y: x < y,
+    "bgeu": lambda x, y: x >= y,
+}
+# size, sign bit
+LOAD = {"lb": (1, 0x80), "lh": (2, 0x8000), "lw": (4, 0), "lbu": (1, 0), "lhu": (2, 0)}
+STORE = {"sb": 1, "sh": 2, "sw": 4}
+
+
+# *** Execute ***
+# Each op applies one decoded instruction to the harts in idx, all of which
+# are at d.pc: an index array, or ALL when that is every hart, so register
+# accesses can use views instead of copies.
+
+ALL = slice(None)
+
+
+def retire(b, d, idx, value):
+    if (d.rd != 0):
+        b.regs[idx, d.rd] = value
+    b.pc[idx] = d.next
+    b.instret[idx] += 1
+
+
+def alu(f):
+    def op(b, d, idx):
+        retire(b, d, idx, f(b.regs[idx, d.rs1], b.regs[idx, d.rs2]))
+    return op
+
+
+def alu_imm(f):
+    def op(b, d, idx):
+        retire(b, d, idx, f(b.regs[idx, d.rs1], d.imm))
+    return op
+
+
+def branch(f):
+    def op(b, d, idx):
+        taken = f(b.regs[idx, d.rs1], b.regs[idx, d.rs2])
+        b.pc[idx] = np.where(taken, d.imm, d.next)
+        b.instret[idx] += 1
+    return op
+
+
+def load(size, sign):
+    def op(b, d, idx):
+        idx, off = b.translate(idx, b.regs[idx, d.rs1] + d.imm, size)
+        value = b.memory[idx, off].astype(np.uint32)
+        for k in range(1, size):
+            value |= b.memory[idx, off + k].astype(np.uint32) << np.uint32(8 * k)
+        if (sign):
+            value = (value ^ np.uint32(sign)) - np.uint32(sign)
+        retire(b, d, idx, value)
+    return op
+
+
+def store(size):
+    def op(b, d, idx):
+        addr = b.regs[idx, d.rs1] + d.imm
+        if (np.isin(addr >> np.uint32(PAGE_SHIFT), b.code).any()):
+            b.ops.clear()
+            b.code = np.zeros(0, np.uint32)
+        idx, off = b.translate(idx, addr, size)
+        value = b.regs[idx, d.rs2]
+        for k in range(size):
+            b.memory[idx, off + k] = (value >> np.uint32(8 * k)).astype(np.uint8)
+        retire(b, d, idx, None)
+    return op
+
+
+def op_lui(b, d, idx):
+    # imm is the value, for auipc already pc-relative
+    retire(b, d, idx, d.imm)
+
+
+def op_jal(b, d, idx):
+    if (d.rd != 0):
+        b.regs[idx, d.rd] = d.next
+    b.pc[idx] = d.imm
+    b.instret[idx] += 1
+
+
+def op_jalr(b, d, idx):
+    target = (b.regs[idx, d.rs1] + d.imm) & np.uint32(0xFFFFFFFE)
+    if (d.rd != 0):
+        b.regs[idx, d.rd] = d.next
+    b.pc[idx] = target
+    b.instret[idx] += 1
+
+
+def op_fence(b, d, idx):
+    retire(b, d, idx, None)
+
+
+def stop(status):
+    def op(b, d, idx):
+        b.stop(idx, status)
+    return op
+
+
+OPS = {"lui": op_lui, "auipc": op_lui, "jal": op_jal, "jalr": op_jalr,
+       "fence": op_fence, "fence.i": op_fence, "ecall": stop(ECALL), "ebreak": stop(EBREAK)}
+OPS.update({name: alu(f) for name, f in ALU.items()})
+OPS.update({name: alu_imm(ALU[base]) for name, base in ALU_IMM.items()})
+OPS.update({name: branch(f) for name, f in BRANCH.items()})
+OPS.update({name: load(*x) for name, x in LOAD.items()})
+OPS.update({name: store(size) for name, size in STORE.items()})
+
+
+class Batch:
+    def __init__(self, n):
+        self.n = n
+        self.regs = np.zeros((n, 32), np.uint32)
+        self.pc = np.zeros(n, np.uint32)
+        self.status = np.zeros(n, np.uint8)
+        self.instret = np.zeros(n, np.int64)
+        # sorted page numbers; page pns[i] is columns i * PAGE_SIZE.. of memory
+        self.pns = np.zeros(0, np.uint32)
+        self.memory = np.zeros((n, 0), np.uint8)
+        self.max_pages = max(1, MEMORY // (n * PAGE_SIZE))
+        # pc -> Op, and the pages they were decoded from
+        self.ops = {}
+        self.code = np.zeros(0, np.uint32)
+        self.rows = np.arange(n)
+        # indices of the running harts; None after any of them stopped
+        self.active = None
+
+    def map(self, pns):
+        # allocate the pages in pns that are missing; returns False when
+        # that would go over MEMORY
+        pns = np.setdiff1d(np.asarray(pns, np.uint32), self.pns)
+        if (len(pns) == 0):
+            return True
+        if (len(self.pns) + len(pns) > self.max_pages):
+            return False
+        all = np.union1d(self.pns, pns)
+        memory = np.zeros((self.n, len(all) * PAGE_SIZE), np.uint8)
+        for i, slot in enumerate(np.searchsorted(all, self.pns)):
+            memory[:, slot * PAGE_SIZE:(slot + 1) * PAGE_SIZE] = self.memory[:, i * PAGE_SIZE:(i + 1) * PAGE_SIZE]
+        self.pns = all
+        self.memory = memory
+        return True
+
+    def slots(self, pn):
+        slot = np.searchsorted(self.pns, pn)
+        np.minimum(slot, len(self.pns) - 1, out=slot)
+        return slot, self.pns[slot] == pn
+
+    def translate(self, idx, addr, size):
+        # (harts, memory columns) for an access of size bytes at addr by
+        # each hart in idx; harts whose access can't be mapped fault and
+        # are left out
+        if (idx is ALL):
+            idx = self.rows
+        first = addr >> np.uint32(PAGE_SHIFT)
+        last = (addr + np.uint32(size - 1)) >> np.uint32(PAGE_SHIFT)
+        slot, hit = self.slots(first) if len(self.pns) else (None, np.zeros(len(idx), bool))
+        if (not hit.all()):
+            self.map(np.unique(first[~hit]))
+            slot, hit = self.slots(first)
+        if (size > 1):
+            cross = first != last
+            if (cross.any()):
+                self.map(np.unique(last[cross & (last == first + np.uint32(1))]))
+                slot, hit = self.slots(first)
+                after, mapped = self.slots(last)
+                hit &= ~cross | (mapped & (after == slot + 1))
+        if (not hit.all()):
+            self.stop(idx[~hit], FAULT)
+            idx, slot, addr = idx[hit], slot[hit], addr[hit]
+        return idx, slot * PAGE_SIZE + (addr & np.uint32(PAGE_MASK))
+
+    def load(self, addr, data, harts=slice(None)):
+        # copy data to addr in every hart's memory (or those in harts)
+        if (not data):
+            return
+        if (not self.map(np.arange(addr >> PAGE_SHIFT, ((addr + len(data) - 1) >> PAGE_SHIFT) + 1))):
+            raise Exception("out of memory")
+        buf = np.frombuffer(data, np.uint8)
+        pos = 0
+        while pos < len(buf):
+            a = addr + pos
+            slot, _ = self.slots(np.array([a >> PAGE_SHIFT], np.uint32))
+            off = int(slot[0]) * PAGE_SIZE + (a & PAGE_MASK)
+            k = min(len(buf) - pos, PAGE_SIZE - (a & PAGE_MASK))
+            self.memory[harts, off:off + k] = buf[pos:pos + k]
+            pos += k
+
+    def load_elf(self, f):
+        # every PT_LOAD segment into every hart, all starting at the entry
+        e = elf.read(f)
+        for s in e.segments:
+            if (s.p_type != elf.PT_LOAD or s.p_memsz == 0):
+                continue
+            self.map(np.arange(s.p_paddr >> PAGE_SHIFT, ((s.p_paddr + s.p_memsz - 1) >> PAGE_SHIFT) + 1))
+            self.load(s.p_paddr, bytes(e.contents(s)))
+        self.pc[:] = e.entry
+
+    def read(self, hart, addr, length):
+        # bytes from one hart's memory; unmapped pages read as zeros
+        out = bytearray()
+        for a in range(addr, addr + length):
+            slot, hit = self.slots(np.array([a >> PAGE_SHIFT], np.uint32)) if len(self.pns) else (0, [False])
+            out.append(int(self.memory[hart, int(slot[0]) * PAGE_SIZE + (a & PAGE_MASK)]) if hit[0] else 0)
+        return bytes(out)
+
+    def stop(self, idx, status):
+        self.status[idx] = status
+        self.active = None
+
+    def fetch(self, pc, idx):
+        # Op at pc for the harts in idx, None when they stopped on it
+        hart, off = self.translate(self.rows[idx][:1], np.array([pc], np.uint32), 4)
+        if (len(hart) == 0):
+            self.stop(idx, FAULT)
+            return None
+        word = int.from_bytes(self.memory[hart[0], off[0]:off[0] + 4].tobytes(), "little")
+        if (word == 0):
+            self.stop(idx, HALT)
+            return None
+        try:
+            insn = cpu1.decode(pc, word)
+        except Exception:
+            insn = None
+        if (insn is None or insn.name not in OPS):
+            self.stop(idx, FAULT)
+            return None
+        self.code = np.union1d(self.code, [pc >> PAGE_SHIFT, ((pc + 3) & MASK) >> PAGE_SHIFT]).astype(np.uint32)
+        d = self.ops[pc] = Op(insn, OPS[insn.name])
+        return d
+
+    def step(self):
+        # one instruction on every running hart; returns how many ran
+        if (self.active is None):
+            self.active = np.flatnonzero(self.status == RUNNING)
+        active = self.active
+        if (len(active) == 0):
+            return 0
+        pcs = self.pc[active]
+        pc = pcs[0]
+        if ((pcs == pc).all()):
+            groups = [(int(pc), ALL if len(active) == self.n else active)]
+        else:
+            order = np.argsort(pcs, kind="stable")
+            pcs = pcs[order]
+            bounds = np.flatnonzero(pcs[1:] != pcs[:-1]) + 1
+            groups = zip(pcs[np.r_[0, bounds]].tolist(), np.split(active[order], bounds))
+        ops = self.ops
+        for pc, idx in groups:
+            d = ops.get(pc) or self.fetch(pc, idx)
+            if (d is not None):
+                d.fn(self, d, idx)
+        return len(active)
+
+    def run(self, steps):
+        # up to steps steps, until every hart stopped; returns the steps run
+        for i in range(steps):
+            if (self.step() == 0):
+                return i
+        return steps
+
+    def counts(self):
+        # status name -> number of harts
+        return {name: int(n) for name, n in zip(STATUS, np.bincount(self.status, minlength=len(STATUS))) if n}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="run many harts in lockstep")
+    parser.add_argument("elf", nargs="?")
+    parser.add_argument("-n", "--harts", type=int, default=1024)
+    parser.add_argument("-w", "--workload", help="run one of bench.py's workloads instead")
+    parser.add_argument("--steps", type=int, default=10000000, help="stop after this many steps")
+    args = parser.parse_args()
+
+    b = Batch(args.harts)
+    if (args.workload):
+        import bench
+        w = bench.WORKLOADS[args.workload](bench.SIZES[args.workload])
+        b.load(w.entry, w.image)
+        for addr, data in w.data:
+            b.load(addr, data)
+        b.pc[:] = w.entry
+    elif (args.elf):
+        with open(args.elf, "rb") as f:
+            b.load_elf(f)
+    else:
+        parser.error("an ELF or a workload is needed")
+    start = time.perf_counter()
+    steps = b.run(args.steps)
+    seconds = time.perf_counter() - start
+    total = int(b.instret.sum())
+    print("%d harts, %d steps, %d instructions in %.3fs, %.3f MIPS" % (
+        b.n, steps, total, seconds, total / seconds / 1e6 if seconds > 0 else 0.0))
+    print(", ".join("%s %d" % x for x in b.counts().items()))
+    if (args.workload):
+        correct = int((b.regs[:, bench.A0] == w.expected).sum())
+        print("a0 correct on %d/%d harts" % (correct, b.n))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,351 @@
+#!/usr/bin/python3
+
+# Emulator benchmarks: synthetic RV32I workloads assembled in memory (no
+# toolchain needed), run on every engine with warmup and repetitions, and
+# reported as instructions per second.
+#
+#   ./bench.py [-e ENGINE ...] [-w WORKLOAD ...] [--repeat N] [--warmup N] [--scale X] [--json out.json]
+#
+# Every workload leaves a checksum in a0 that is checked against a Python
+# model of the same loop, so an engine that runs fast but wrong shows up as
+# such. A workload ends with gp = 1; ecall, followed by a zero word. Every
+# engine counts the ecall as an instruction it ran, and nothing after it.
+
+import argparse
+import json
+import statistics
+import sys
+import time
+
+from asm import Program
+
+CODE = 0x80000000
+DATA = 0x80100000
+STACK = 0x80200000
+MASK = 0xFFFFFFFF
+
+# ABI register numbers
+ZERO, RA, SP, GP = 0, 1, 2, 3
+T0, T1, T2, T3 = 5, 6, 7, 28
+S0, S1, S2 = 8, 9, 18
+A0 = 10
+
+
+class Workload:
+    def __init__(self, name, program, expected, data=()):
+        self.name = name
+        self.image = program.image()
+        self.entry = program.base
+        # value of a0 after a correct run
+        self.expected = expected
+        # (addr, bytes) to load next to the code
+        self.data = list(data)
+
+
+# *** Workloads ***
+# n scales the amount of work; each builder returns a Workload.
+
+def straight(n):
+    # straight-line addi/slli/add, no branches, loads or stores: the only
+    # workload the original interpreter can run to the end. Every
+    # instruction runs once, so this measures decode more than execution
+    p = Program()
+    a0 = 0
+    for i in range(n // 3):
+        p.op("addi", A0, A0, imm=7)
+        p.op("slli", T0, A0, imm=1)
+        p.op("add", A0, A0, T0)
+        a0 = (a0 + 7) * 3 & MASK
+    p.exit()
+    return Workload("straight", p, a0)
+
+
+def alu(n):
+    p = Program()
+    p.li(A0, 0x12345678)
+    p.li(S0, max(1, n // 10))
+    p.label("loop")
+    p.op("add", T0, A0, S0)
+    p.op("slli", T1, T0, imm=3)
+    p.op("srli", T2, T0, imm=5)
+    p.op("xor", A0, T1, T2)
+    p.op("sub", A0, A0, S0)
+    p.op("andi", T3, A0, imm=0xff)
+    p.op("or", A0, A0, T3)
+    p.op("addi", A0, A0, imm=0x123)
+    p.op("addi", S0, S0, imm=-1)
+    p.op("bne", rs1=S0, rs2=ZERO, target="loop")
+    p.exit()
+
+    a0 = 0x12345678
+    for s0 in range(max(1, n // 10), 0, -1):
+        t0 = (a0 + s0) & MASK
+        a0 = ((t0 << 3) & MASK) ^ (t0 >> 5)
+        a0 = (a0 - s0) & MASK
+        a0 = (a0 | (a0 & 0xff)) + 0x123 & MASK
+    return Workload("alu", p, a0)
+
+
+def branchy(n):
+    # a four-way if/else chain on i % 4
+    p = Program()
+    p.op("addi", S0, ZERO, imm=0)
+    p.li(S1, max(1, n // 7))
+    p.op("addi", A0, ZERO, imm=0)
+    p.op("addi", T1, ZERO, imm=2)
+    p.label("loop")
+    p.op("andi", T0, S0, imm=3)
+    p.op("beq", rs1=T0, rs2=ZERO, target="case0")
+    p.op("blt", rs1=T0, rs2=T1, target="case1")
+    p.op("beq", rs1=T0, rs2=T1, target="case2")
+    p.op("addi", A0, A0, imm=-7)
+    p.op("jal", ZERO, target="next")
+    p.label("case0")
+    p.op("addi", A0, A0, imm=1)
+    p.op("jal", ZERO, target="next")
+    p.label("case1")
+    p.op("addi", A0, A0, imm=3)
+    p.op("jal", ZERO, target="next")
+    p.label("case2")
+    p.op("xor", A0, A0, S0)
+    p.label("next")
+    p.op("addi", S0, S0, imm=1)
+    p.op("bltu", rs1=S0, rs2=S1, target="loop")
+    p.exit()
+
+    a0 = 0
+    for i in range(max(1, n // 7)):
+        a0 = [a0 + 1, a0 + 3, a0 ^ i, a0 - 7][i & 3] & MASK
+    return Workload("branchy", p, a0)
+
+
+def memcpy(n):
+    # copy a 1 KB buffer word by word, then checksum the copy with lbu/lhu and
+    # store the sum back into the source, once per ~3300 instructions
+    words = 256
+    src, dst = DATA, DATA + 0x1000
+    reps = max(1, n // 3300)
+    p = Program()
+    p.li(S2, reps)
+    p.op("addi", A0, ZERO, imm=0)
+    p.label("outer")
+    p.li(T0, src)
+    p.li(T1, dst)
+    p.op("addi", T2, ZERO, imm=words)
+    p.label("copy")
+    p.op("lw", T3, T0, imm=0)
+    p.op("sw", rs1=T1, rs2=T3, imm=0)
+    p.op("addi", T0, T0, imm=4)
+    p.op("addi", T1, T1, imm=4)
+    p.op("addi", T2, T2, imm=-1)
+    p.op("bne", rs1=T2, rs2=ZERO, target="copy")
+    p.li(T1, dst)
+    p.op("addi", T2, ZERO, imm=words)
+    p.label("sum")
+    p.op("lbu", T3, T1, imm=0)
+    p.op("add", A0, A0, T3)
+    p.op("lhu", T3, T1, imm=2)
+    p.op("add", A0, A0, T3)
+    p.op("addi", T1, T1, imm=4)
+    p.op("addi", T2, T2, imm=-1)
+    p.op("bne", rs1=T2, rs2=ZERO, target="sum")
+    p.li(T0, src)
+    p.op("sb", rs1=T0, rs2=A0, imm=0)
+    p.op("addi", S2, S2, imm=-1)
+    p.op("bne", rs1=S2, rs2=ZERO, target="outer")
+    p.exit()
+
+    buf = bytearray(i * 7 & 0xff for i in range(4 * words))
+    a0 = 0
+    for _ in range(reps):
+        for i in range(0, len(buf), 4):
+            a0 += buf[i] + (buf[i + 2] | buf[i + 3] << 8)
+        a0 &= MASK
+        buf[0] = a0 & 0xff
+    return Workload("memcpy", p, a0, [(src, bytes(i * 7 & 0xff for i in range(4 * words)))])
+
+
+def calls(n):
+    # three nested calls per iteration (~24 instructions), spilling ra to
+    # the stack
+    p = Program()
+    p.li(SP, STACK)
+    p.li(S0, max(1, n // 24))
+    p.op("addi", A0, ZERO, imm=0)
+    p.label("loop")
+    p.op("jal", RA, target="f")
+    p.op("addi", S0, S0, imm=-1)
+    p.op("bne", rs1=S0, rs2=ZERO, target="loop")
+    p.op("jal", ZERO, target="done")
+    for fn, callee, body in (("f", "g", [("addi", A0, A0, 0, 1)]),
+                             ("g", "h", [("slli", T0, A0, 0, 1), ("add", A0, A0, T0, 0)])):
+        p.label(fn)
+        p.op("addi", SP, SP, imm=-8)
+        p.op("sw", rs1=SP, rs2=RA, imm=4)
+        for name, rd, rs1, rs2, imm in body:
+            p.op(name, rd, rs1, rs2, imm)
+        p.op("jal", RA, target=callee)
+        p.op("lw", RA, SP, imm=4)
+        p.op("addi", SP, SP, imm=8)
+        p.op("jalr", ZERO, RA, imm=0)
+    p.label("h")
+    p.op("xori", A0, A0, imm=0x55)
+    p.op("jalr", ZERO, RA, imm=0)
+    p.label("done")
+    p.exit()
+
+    a0 = 0
+    for _ in range(max(1, n // 24)):
+        a0 = ((a0 + 1) * 3 & MASK) ^ 0x55
+    return Workload("calls", p, a0)
+
+
+# name -> builder; n is roughly the number of instructions executed
+WORKLOADS = {"straight": straight, "alu": alu, "branchy": branchy, "memcpy": memcpy, "calls": calls}
+SIZES = {"straight": 3000, "alu": 100000, "branchy": 100000, "memcpy": 100000, "calls": 100000}
+
+
+# *** Engines ***
+# An engine takes a Workload and a limit, runs it from a fresh state and
+# returns (instructions, seconds, a0). Only the run itself is timed.
+
+def engine_cpu(w, limit):
+    import cpu
+    cpu.init()
+    cpu.load(w.entry, w.image)
+    for addr, data in w.data:
+        cpu.load(addr, data)
+    cpu.regfile[cpu.PC] = w.entry
+    instrcnt = 0
+    start = time.perf_counter()
+    while instrcnt < limit:
+        # process() is False after the ecall
+        instrcnt += 1
+        if (not cpu.process()):
+            break
+    return instrcnt, time.perf_counter() - start, cpu.regfile[A0]
+
+
+def engine_cpu1_process(w, limit):
+    import cpu1
+    cpu1.init()
+    cpu1.load(w.entry, w.image)
+    for addr, data in w.data:
+        cpu1.load(addr, data)
+    cpu1.regfile[cpu1.PC] = w.entry
+    instrcnt = 0
+    start = time.perf_counter()
+    while instrcnt < limit and cpu1.process():
+        instrcnt += 1
+    return instrcnt, time.perf_counter() - start, cpu1.regfile[A0]
+
+
+def machine(w):
+    import cpu1
+    m = cpu1.Machine()
+    m.load(w.entry, w.image)
+    for addr, data in w.data:
+        m.load(addr, data)
+    m.regs[cpu1.PC] = w.entry
+    return m
+
+
+def engine_cpu1_run(w, limit):
+    m = machine(w)
+    start = time.perf_counter()
+    # stop after the ecall rather than in front of it
+    instrcnt = m.run(limit, stop_on=()).instructions
+    return instrcnt, time.perf_counter() - start, m.regs[A0]
+
+
+def engine_cpu1_blocks(w, limit):
+    m = machine(w)
+    start = time.perf_counter()
+    instrcnt = m.run_blocks(limit)
+    return instrcnt, time.perf_counter() - start, m.regs[A0]
+
+
+# harts of the batch engine
+HARTS = 256
+
+
+def engine_batch(w, limit):
+    # HARTS copies of the workload in lockstep; instructions are counted
+    # over all of them, a0 is right only if it is on every hart
+    import batch
+    b = batch.Batch(HARTS)
+    b.load(w.entry, w.image)
+    for addr, data in w.data:
+        b.load(addr, data)
+    b.pc[:] = w.entry
+    start = time.perf_counter()
+    b.run(limit)
+    seconds = time.perf_counter() - start
+    a0 = b.regs[:, A0]
+    # harts stop in front of the ecall; count it as run
+    ecalls = int((b.status == batch.ECALL).sum())
+    return int(b.instret.sum()) + ecalls, seconds, int(a0[0]) if (a0 == a0[0]).all() else None
+
+
+ENGINES = {"cpu": engine_cpu,
+           "cpu1-process": engine_cpu1_process,
+           "cpu1-run": engine_cpu1_run,
+           "cpu1-blocks": engine_cpu1_blocks,
+           "batch": engine_batch}
+
+
+def measure(engine, w, repeat, warmup, limit):
+    result = {"engine": engine, "workload": w.name, "instructions": 0, "seconds": [],
+              "mips": None, "mips_best": None, "correct": False, "error": None}
+    run = ENGINES[engine]
+    try:
+        for _ in range(warmup):
+            run(w, limit)
+        for _ in range(repeat):
+            instrcnt, seconds, a0 = run(w, limit)
+            result["seconds"].append(seconds)
+    except Exception as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+        return result
+    result["instructions"] = instrcnt
+    result["correct"] = a0 == w.expected
+    result["mips"] = instrcnt / statistics.median(result["seconds"]) / 1e6
+    result["mips_best"] = instrcnt / min(result["seconds"]) / 1e6
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the emulators")
+    parser.add_argument("-e", "--engine", action="append", choices=ENGINES,
+                        help="engines to run (default: all)")
+    parser.add_argument("-w", "--workload", action="append", choices=WORKLOADS,
+                        help="workloads to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per measurement")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed runs first")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply workload sizes")
+    parser.add_argument("--limit", type=int, default=10000000, help="instructions per run")
+    parser.add_argument("--json", help="write the results here")
+    args = parser.parse_args()
+
+    workloads = [WORKLOADS[x](max(3, int(SIZES[x] * args.scale))) for x in args.workload or WORKLOADS]
+    results = []
+    print("%-14s %-10s %10s %9s %9s %s" % ("engine", "workload", "insns", "MIPS", "best", ""))
+    for engine in args.engine or ENGINES:
+        for w in workloads:
+            r = measure(engine, w, args.repeat, args.warmup, args.limit)
+            results.append(r)
+            if (r["error"]):
+                print("%-14s %-10s %10s %9s %9s %s" % (engine, w.name, "-", "-", "-", r["error"]))
+                continue
+            print("%-14s %-10s %10d %9.3f %9.3f %s" % (
+                engine, w.name, r["instructions"], r["mips"], r["mips_best"],
+                "" if r["correct"] else "WRONG RESULT"))
+    if (args.json):
+        with open(args.json, "w") as f:
+            json.dump({"python": sys.version, "repeat": args.repeat, "warmup": args.warmup,
+                       "scale": args.scale, "results": results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
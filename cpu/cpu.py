@@ -1,69 +1,14 @@
 #!/usr/bin/python3
 
 import sys
-from elftools.elf.elffile import ELFFile
 import glob
 import binascii
 import subprocess
 from enum import Enum
-import struct
-
-
-INSTR = {"lui":   {"opcode": 0b0110111, "type": "U", "funct3": 0x0},
-         "auipc": {"opcode": 0b0010111, "type": "U", "funct3": 0x0},
-         "jal":   {"opcode": 0b1101111, "type": "J", "funct3": 0x0},
-
-         "jalr":  {"opcode": 0b1100111, "type": "I", "funct3": 0x0},
-
-         "beq":   {"opcode": 0b1100011, "type": "B", "funct3": 0x0},
-         "bne":   {"opcode": 0b1100011, "type": "B", "funct3": 0x1},
-         "blt":   {"opcode": 0b1100011, "type": "B", "funct3": 0x4},
-         "bge":   {"opcode": 0b1100011, "type": "B", "funct3": 0x5},
-         "bltu":  {"opcode": 0b1100011, "type": "B", "funct3": 0x6},
-         "bgeu":  {"opcode": 0b1100011, "type": "B", "funct3": 0x7},
-
-         "lb":    {"opcode": 0b0000011, "type": "I", "funct3": 0x0},
-         "lh":    {"opcode": 0b0000011, "type": "I", "funct3": 0x1},
-         "lw":    {"opcode": 0b0000011, "type": "I", "funct3": 0x2},
-         "lbu":   {"opcode": 0b0000011, "type": "I", "funct3": 0x4},
-
-         "lhu":   {"opcode": 0b0000011, "type": "I", "funct3": 0x5},
-         "sb":    {"opcode": 0b0100011, "type": "S", "funct3": 0x0},
-         "sh":    {"opcode": 0b0100011, "type": "S", "funct3": 0x1},
-
-         "sw":    {"opcode": 0b0100011, "type": "S", "funct3": 0x2},
-         "addi":  {"opcode": 0b0010011, "type": "I", "funct3": 0x0},
-         "slti":  {"opcode": 0b0010011, "type": "I", "funct3": 0x2},
-         "sltiu": {"opcode": 0b0010011, "type": "I", "funct3": 0x3},
-         "xori":  {"opcode": 0b0010011, "type": "I", "funct3": 0x4},
-         "ori":   {"opcode": 0b0010011, "type": "I", "funct3": 0x6},
-         "andi":  {"opcode": 0b0010011, "type": "I", "funct3": 0x7},
-         "slli":  {"opcode": 0b0010011, "type": "I", "funct3": 0x1},
-         "srli":  {"opcode": 0b0010011, "type": "I", "funct3": 0x5},
-         "srai":  {"opcode": 0b0010011, "type": "I", "funct3": 0x5},
-
-         "add":   {"opcode": 0b0110011, "type": "R", "funct3": 0x0},
-         "sub":   {"opcode": 0b0110011, "type": "R", "funct3": 0x0},
-         "sll":   {"opcode": 0b0110011, "type": "R", "funct3": 0x1},
-         "slt":   {"opcode": 0b0110011, "type": "R", "funct3": 0x2},
-         "sltu":  {"opcode": 0b0110011, "type": "R", "funct3": 0x3},
-         "xor":   {"opcode": 0b0110011, "type": "R", "funct3": 0x4},
-         "srl":   {"opcode": 0b0110011, "type": "R", "funct3": 0x5},
-         "sra":   {"opcode": 0b0110011, "type": "R", "funct3": 0x5},
-         "or":    {"opcode": 0b0110011, "type": "R", "funct3": 0x6},
-         "and":   {"opcode": 0b0110011, "type": "R", "funct3": 0x7},
-
-         # SYSTEM
-         "csrrw": {"opcode": 0b1110011, "type": "I", "funct3": 0x1},
-         "csrrs": {"opcode": 0b1110011, "type": "I", "funct3": 0x2},
-         "csrrc": {"opcode": 0b1110011, "type": "I", "funct3": 0x3},
-         "csrrwi": {"opcode": 0b1110011, "type": "I", "funct3": 0x5},
-         "csrrsi": {"opcode": 0b1110011, "type": "I", "funct3": 0x6},
-         "csrrci": {"opcode": 0b1110011, "type": "I", "funct3": 0x7},
-
-         # MISC-MEM
-         "fence": {"opcode": 0b0001111, "type": "I", "funct3": 0x0},
-         }
+from memory import Memory
+import loader
+from tracing import Trace
+
 
 # Masks
 OPCODE_MASK = 0x7F
@@ -85,13 +30,6 @@ J_IMM101_MASK = 0x7FE00000
 J_IMM = 0xFFFFF000
 
 
-def find_instr_name(opcode, instr_type, funct3):
-    for parent_key, inner_dict in INSTR.items():
-        if inner_dict["opcode"] == opcode and inner_dict["type"] == instr_type and inner_dict["funct3"] == funct3:
-            return parent_key
-    return ""  # Return None if no match is found
-
-
 # Concatenate two binary numbers
 def concat(a, b):
     return int(f"{a}{b}")
@@ -266,6 +204,8 @@ regnames = ["x0", "ra", "sp", "gp", "tp"] + ["t%d" % i for i in range(0, 3)] + [
     "a%d" % i for i in range(0, 8)] + ["s%d" % i for i in range(2, 12)] + ["t%d" % i for i in range(3, 7)] + ["PC"]
 
 memory = None
+# tracing.Trace; set it to record every instruction
+trace = None
 PC = 32
 
 
@@ -284,16 +224,13 @@ class Regfile:
 
 def init():
     global memory, regfile
-    # 16kb memory
-    memory = b'\x00' * 0x4000
+    # sparse 32-bit address space, pages allocated on demand
+    memory = Memory()
     regfile = Regfile()
 
 
 def load(addr, data):
-    global memory
-    addr -= 0x80000000
-    assert addr >= 0 and addr < len(memory)
-    memory = memory[:addr] + data + memory[addr + len(data):]
+    memory.load(addr, data)
 
 
 def readelf(args):
@@ -301,8 +238,7 @@ def readelf(args):
 
 
 def fetch(addr):
-    assert addr >= 0 and addr < len(memory)
-    return struct.unpack("<I", memory[addr:addr + 4])[0]
+    return memory.read32(addr)
 
 
 def extractBits(instr, s, e):
@@ -356,14 +292,9 @@ def execute(instruction_type, instruction_elements):
         if (op == OP.SYSTEM and ((funct3 == FUNCT3.CSRRW) or (funct3 == FUNCT3.CSRRS) or (funct3 == FUNCT3.CSRRC) or (funct3 == FUNCT3.CSRRWI) or (funct3 == FUNCT3.CSRRSI) or (funct3 == FUNCT3.CSRRCI))):  # csrrw
             # TODO: needs to be completed
             pass
+        # ecall stops the run; ebreak and mret are skipped
         if (op == OP.SYSTEM and (funct3 == FUNCT3.ECALL) and imm == 0x0):
-            print("ecall")
             return False
-        elif (op == OP.SYSTEM and (funct3 == FUNCT3.EBREAK) and imm == 0x1):
-            print("ebreak")
-        elif (op == OP.SYSTEM and (funct3 == FUNCT3.MRAT) and imm == 0x302):
-            print("mrat")
-            # return False
     elif (instruction_type == 'R'):
         [funct7, rs2, rs1, funct3, rd, opcode] = instruction_elements
         op = OP(opcode)
@@ -386,9 +317,6 @@ def execute(instruction_type, instruction_elements):
                 regfile[rs2], 32)
         if (cond):
             regfile[PC] += imm
-
-            print(hex(imm), regfile[rs2], regnames[rs2], regfile[rs1],
-                  regnames[rs1], funct3, hex(opcode), hex(regfile[PC]))
     elif (instruction_type == 'J'):
         [imm, rd, opcode] = instruction_elements
         op = OP(opcode)
@@ -419,22 +347,22 @@ def process():
     opcode = extractBits(instruction, 6, 0)
     instruction_type = find_instruction_type(opcode)
 
-    funct3 = extractBits(instruction, 14, 12)
-    # table rows
-    # -----------------------------------------------------------------------
-    print("{:<12} {:<4} {:<5} {:<13} {:<10} {:<5}".format(
-        hex(instruction), "->", instruction_type, OP(opcode), hex(regfile[PC]), find_instr_name(opcode, instruction_type, funct3)))
-    # -----------------------------------------------------------------------
+    pc = regfile[PC]
 
     # *** Execute ***
     intruction_elements = instruction_parsing(
         instruction_type, instruction)
-    execute(instruction_type, intruction_elements)
-    # dump()
-    return True
+    running = execute(instruction_type, intruction_elements)
+    if (trace is not None):
+        rd = extractBits(instruction, 11, 7) if instruction_type in "UIRJ" else 0
+        trace.append(pc, instruction, rd, regfile[rd], 0)
+    return running
 
 
 def main():
+    # ./cpu.py [--trace]; --trace writes <test>.trace next to each test,
+    # pretty-print it with ./tracing.py
+    global trace
     for x in glob.glob("/home/adam/dev/riscv-tests/isa/rv32ui-p-add"):
         if (x.endswith('.dump')):
             continue
@@ -442,18 +370,18 @@ def main():
             # readelf(["readelf", x, "-e"])
             print("test", x)
             init()
-            elffile = ELFFile(f)
-            for segment in elffile.iter_segments():
-                if (segment.header.p_paddr < 0x80000000):
-                    continue
-                load(segment.header.p_paddr, segment.data())
-                # print(segment.header.p_paddr, binascii.hexlify(segment.data()))
-            # regfile[PC] = 0x80000000
-            regfile[PC] = 0x0
+            loader.load_elf(memory, f)
+            regfile[PC] = 0x80000000
+            if ("--trace" in sys.argv[1:]):
+                trace = Trace()
             instrcnt = 0
             while process():
                 instrcnt += 1
             print("run %d instructions" % instrcnt)
+            dump()
+            if (trace is not None):
+                with open(x + ".trace", "wb") as t:
+                    trace.save(t)
 
 
 if __name__ == '__main__':
@@ -1,90 +1,39 @@
 #!/usr/bin/python3
 
-from elftools.elf.elffile import ELFFile
+from jit import BlockCache
+from memory import Memory, PAGE_SHIFT, PAGE_SIZE
 import glob
+import operator
+import sys
 import subprocess
-from enum import Enum
-import struct
-
-
-class OP(Enum):
-    LUI = 0b0110111
-    AUIPC = 0b0010111
-    JAL = 0b1101111
-    JALR = 0b1100111
-    BRANCH = 0b1100011
-    LOAD = 0b0000011
-    STORE = 0b0100011
-    OP_IMM = 0b0010011
-    OP = 0b0110011
-    MISC_MEM = 0b0001111
-    SYSTEM = 0b1110011
-
-
-class FUNCT3(Enum):
-    JALR = 0b000
-
-    BEQ = 0b000
-    BNE = 0b001
-    BLT = 0b100
-    BGE = 0b101
-    BLTU = 0b110
-    BGEU = 0b111
-
-    LB = 0b000
-    LH = 0b001
-    LW = 0b010
-    LBU = 0b100
-    LHU = 0b101
-
-    SB = 0b000
-    SH = 0b001
-    SW = 0b010
-
-    # OP-IMM
-    ADDI = 0b000
-    SLTI = 0b010
-    SLTIU = 0b011
-
-    XORI = 0b100
-    ORI = 0b110
-    ANDI = 0b111
-
-    SLLI = 0b001
-    SRLI = 0b101
-    SRAI = 0b101
-
-    # OP
-    ADD = 0b000
-    SUB = 0b000
-    SLL = 0b001
-    SLT = 0b010
-    SLTU = 0b011
-    XOR = 0b100
-    SRL = 0b101
-    SRA = 0b101
-    OR = 0b110
-    AND = 0b111
-
-    FENCE = 0b000
-    ECALL = 0b000
-    EBREAK = 0b000
-    MRAT = 0b000
-
-    CSRRW = 0b001
-    CSRRS = 0b010
-    CSRRC = 0b011
-    CSRRWI = 0b101
-    CSRRSI = 0b110
-    CSRRCI = 0b111
-
-
-regnames = ["x0", "ra", "sp", "gp", "tp"] + ["t%d" % i for i in range(0, 3)] + ["s0", "s1"] + [
-    "a%d" % i for i in range(0, 8)] + ["s%d" % i for i in range(2, 12)] + ["t%d" % i for i in range(3, 7)] + ["PC"]
+import time
+import isa
+import loader
+from isa import regnames
+from snapshot import Snapshot
+from tracing import Histogram, Trace, LOADS, STORES
+from uart import UART
+
 
-memory = None
 PC = 32
 
+# counter CSRs; the h variants (| 0x80) read the upper 32 bits
+CYCLE, TIME, INSTRET = 0xC00, 0xC01, 0xC02
+MCYCLE, MINSTRET = 0xB00, 0xB02
+# rate of the time CSR
+TIME_HZ = 10000000
+# where main() puts the console UART, as on QEMU's virt machine
+UART_BASE = 0x10000000
+
+# why Machine.run() stopped, besides at an instruction it was asked to
+# stop at ("ecall", "ebreak")
+LIMIT, HALT, FAULT, BREAKPOINT = "limit", "halt", "fault", "breakpoint"
+ECALL = "ecall"
+# instructions run() can stop at without checking every instruction; it
+# never caches them, see run_fused()
+STOPS = (ECALL, "ebreak")
+STOP_ON = STOPS + (BREAKPOINT,)
+
 
 class Regfile:
     def __init__(self):
@@ -99,31 +48,10 @@ class Regfile:
         self.regs[key] = value & 0xFFFFFFFF
 
 
-def init():
-    global memory, regfile
-    # 16kb memory
-    memory = b'\x00' * 0x4000
-    regfile = Regfile()
-
-
-def load(addr, data):
-    global memory
-    addr -= 0x80000000
-    assert addr >= 0 and addr < len(memory)
-    memory = memory[:addr] + data + memory[addr + len(data):]
-
-
 def readelf(args):
     subprocess.call(args)
 
 
-def fetch(addr):
-    addr -= 0x80000000
-    if (addr < 0 and addr <= len(memory)):
-        raise Exception("read out of bounds: 0x%x" % addr)
-    return struct.unpack("<I", memory[addr:addr + 4])[0]
-
-
 def sign_extend(x, length):
     # unsigned to signed
     if x >> (length-1) == 1:
@@ -131,233 +59,832 @@ def sign_extend(x, length):
     return x
 
 
-def dump():
-    pp = []
-    for i in range(33):
-        if i != 0 and i % 8 == 0:
-            pp += "\n"
-        pp += " %3s: %08x" % (regnames[i], regfile[i])
-    print(''.join(pp))
+# Decoded instruction record. Everything a handler needs is extracted once
+# per PC and cached, so hot loops skip fetch and decode entirely.
+class Insn:
+    __slots__ = ("pc", "word", "name", "fn", "rd", "rs1", "rs2", "imm", "imm2")
 
+    def __init__(self, pc, word, name, fn, rd=0, rs1=0, rs2=0, imm=0, imm2=0):
+        self.pc = pc
+        self.word = word
+        self.name = name
+        self.fn = fn
+        self.rd = rd
+        self.rs1 = rs1
+        self.rs2 = rs2
+        self.imm = imm
+        # second immediate of a fused pair
+        self.imm2 = imm2
 
-def process():
-    # fetch
-    instruction = fetch(regfile[PC])
-    if (instruction == 0):
-        return False
-
-    # decode
-    # execute
-    # write-back
-    opcode = OP(extractBits(instruction, 6, 0))
-
-    if (opcode == OP.JAL):
-        # J-type instruction
-        rd = extractBits(instruction, 11, 7)
-        imm = extractBits(instruction, 32, 31) << 20 | extractBits(instruction, 30, 21) << 1 | extractBits(
-            instruction, 21, 20) << 11 | extractBits(instruction, 19, 12) << 12
-        offset = sign_extend(imm, 21)
-        regfile[rd] = regfile[PC] + 0x4
-        regfile[PC] += offset
-        return True
-
-    elif (opcode == OP.OP_IMM):
-        # I-type or R-type
-        rd = extractBits(instruction, 11, 7)
-        funct3 = FUNCT3(extractBits(instruction, 14, 12))
-        rs1 = extractBits(instruction, 19, 15)
-        imm = extractBits(instruction, 31, 20)
-        funct7 = extractBits(instruction, 31, 25)
-        value = sign_extend(imm, 12)
-        if (funct3 == FUNCT3.ADDI):
-            regfile[rd] = regfile[rs1] + value
-        elif (funct3 == FUNCT3.SLTI):
-            # treat as signed numbers
-            # if (sign_extend(regfile[rs1], 32) < value):
-            #     regfile[rd] = 1
-            # else:
-            #     regfile[rd] = 0
-            print("slti")
-        elif (funct3 == FUNCT3.SLTIU):
-            # treat as unsigned numbers
-            # if ((regfile[rs1] & 0xFFFFFFFF) < (imm & 0xFFFFFFFF)):
-            #     regfile[rd] = 1
-            # else:
-            #     regfile[rd] = 0
-            print("sltiu")
-        elif (funct3 == FUNCT3.ANDI):
-            regfile[rd] = regfile[rs1] & value
-        elif (funct3 == FUNCT3.ORI):
-            regfile[rd] = regfile[rs1] | value
-        elif (funct3 == FUNCT3.XORI):
-            regfile[rd] = regfile[rs1] ^ value
-        elif (funct3 == FUNCT3.SLLI and funct7 == 0b0000000):
-            shamt = extractBits(instruction, 24, 20)
-            regfile[rd] = regfile[rs1] << shamt
-        elif (funct3 == FUNCT3.SRLI and funct7 == 0b0000000):
-            # zero extend (logical right shift)
-            shamt = extractBits(instruction, 24, 20)
-            regfile[rd] = regfile[rs1] >> shamt
-        elif (funct3 == FUNCT3.SRAI and funct7 == 0b0100000):
-            shamt = extractBits(instruction, 24, 20)
-            # sign-extend (arithmetic right shift)
-            sb = regfile[rs1] >> 31
-            regfile[rd] = regfile[rs1] >> shamt
-            regfile[rd] |= (0xffffffff * sb) << (32 - shamt)
+
+# What Machine.run() returns: why it stopped, how many instructions it ran
+# and how long that took. pc is where it stopped, in front of the
+# instruction it stopped at or the one that faulted; error is the
+# exception of a fault.
+class RunResult:
+    __slots__ = ("reason", "instructions", "seconds", "pc", "error")
+
+    def __init__(self, reason, instructions, seconds, pc, error=None):
+        self.reason = reason
+        self.instructions = instructions
+        self.seconds = seconds
+        self.pc = pc
+        self.error = error
+
+    @property
+    def mips(self):
+        return self.instructions / self.seconds / 1e6 if self.seconds > 0 else 0.0
+
+    def __repr__(self):
+        s = "%s at %08x after %d instructions, %.3fs, %.3f MIPS" % (
+            self.reason, self.pc, self.instructions, self.seconds, self.mips)
+        if (self.error is not None):
+            s += " (%s: %s)" % (type(self.error).__name__, self.error)
+        return s
+
+
+# *** Execute ***
+# Each handler executes one decoded instruction on machine m and updates the
+# PC. Handlers write the raw register list directly and may clobber x0; the
+# run loops zero it again after every instruction.
+
+def op_lui(m, d):
+    # also used for auipc, whose pc-relative value is folded at decode time
+    r = m.regs
+    r[d.rd] = d.imm
+    r[PC] = d.pc + 4
+
+
+def op_jal(m, d):
+    r = m.regs
+    r[d.rd] = d.pc + 4
+    r[PC] = d.imm
+
+
+def op_jalr(m, d):
+    r = m.regs
+    target = (r[d.rs1] + d.imm) & 0xFFFFFFFE
+    r[d.rd] = d.pc + 4
+    r[PC] = target
+
+
+def op_beq(m, d):
+    r = m.regs
+    r[PC] = d.imm if r[d.rs1] == r[d.rs2] else d.pc + 4
+
+
+def op_bne(m, d):
+    r = m.regs
+    r[PC] = d.imm if r[d.rs1] != r[d.rs2] else d.pc + 4
+
+
+# signed compares flip the sign bits and compare unsigned
+
+def op_blt(m, d):
+    r = m.regs
+    r[PC] = d.imm if (r[d.rs1] ^ 0x80000000) < (r[d.rs2] ^ 0x80000000) else d.pc + 4
+
+
+def op_bge(m, d):
+    r = m.regs
+    r[PC] = d.imm if (r[d.rs1] ^ 0x80000000) >= (r[d.rs2] ^ 0x80000000) else d.pc + 4
+
+
+def op_bltu(m, d):
+    r = m.regs
+    r[PC] = d.imm if r[d.rs1] < r[d.rs2] else d.pc + 4
+
+
+def op_bgeu(m, d):
+    r = m.regs
+    r[PC] = d.imm if r[d.rs1] >= r[d.rs2] else d.pc + 4
+
+
+def op_lb(m, d):
+    r = m.regs
+    value = m.memory.read8((r[d.rs1] + d.imm) & 0xFFFFFFFF)
+    r[d.rd] = ((value ^ 0x80) - 0x80) & 0xFFFFFFFF
+    r[PC] = d.pc + 4
+
+
+def op_lbu(m, d):
+    r = m.regs
+    r[d.rd] = m.memory.read8((r[d.rs1] + d.imm) & 0xFFFFFFFF)
+    r[PC] = d.pc + 4
+
+
+def op_lh(m, d):
+    r = m.regs
+    value = m.memory.read16((r[d.rs1] + d.imm) & 0xFFFFFFFF)
+    r[d.rd] = ((value ^ 0x8000) - 0x8000) & 0xFFFFFFFF
+    r[PC] = d.pc + 4
+
+
+def op_lhu(m, d):
+    r = m.regs
+    r[d.rd] = m.memory.read16((r[d.rs1] + d.imm) & 0xFFFFFFFF)
+    r[PC] = d.pc + 4
+
+
+def op_lw(m, d):
+    r = m.regs
+    r[d.rd] = m.memory.read32((r[d.rs1] + d.imm) & 0xFFFFFFFF)
+    r[PC] = d.pc + 4
+
+
+# Stores over cached code (self-modifying code) invalidate it.
+
+def op_sb(m, d):
+    r = m.regs
+    addr = (r[d.rs1] + d.imm) & 0xFFFFFFFF
+    m.memory.write8(addr, r[d.rs2])
+    if ((addr & ~3) in m.decode_cache):
+        m.invalidate(addr, 1)
+    r[PC] = d.pc + 4
+
+
+def op_sh(m, d):
+    r = m.regs
+    addr = (r[d.rs1] + d.imm) & 0xFFFFFFFF
+    m.memory.write16(addr, r[d.rs2])
+    if ((addr & ~3) in m.decode_cache or ((addr + 1) & ~3) in m.decode_cache):
+        m.invalidate(addr, 2)
+    r[PC] = d.pc + 4
+
+
+def op_sw(m, d):
+    r = m.regs
+    addr = (r[d.rs1] + d.imm) & 0xFFFFFFFF
+    m.memory.write32(addr, r[d.rs2])
+    if ((addr & ~3) in m.decode_cache or ((addr + 3) & ~3) in m.decode_cache):
+        m.invalidate(addr, 4)
+    r[PC] = d.pc + 4
+
+
+def op_addi(m, d):
+    r = m.regs
+    r[d.rd] = (r[d.rs1] + d.imm) & 0xFFFFFFFF
+    r[PC] = d.pc + 4
+
+
+def op_slti(m, d):
+    r = m.regs
+    r[d.rd] = int((r[d.rs1] ^ 0x80000000) - 0x80000000 < d.imm)
+    r[PC] = d.pc + 4
+
+
+def op_sltiu(m, d):
+    # the sign-extended immediate is compared as unsigned
+    r = m.regs
+    r[d.rd] = int(r[d.rs1] < (d.imm & 0xFFFFFFFF))
+    r[PC] = d.pc + 4
+
+
+def op_andi(m, d):
+    r = m.regs
+    r[d.rd] = r[d.rs1] & d.imm & 0xFFFFFFFF
+    r[PC] = d.pc + 4
+
+
+def op_ori(m, d):
+    r = m.regs
+    r[d.rd] = (r[d.rs1] | d.imm) & 0xFFFFFFFF
+    r[PC] = d.pc + 4
+
+
+def op_xori(m, d):
+    r = m.regs
+    r[d.rd] = (r[d.rs1] ^ d.imm) & 0xFFFFFFFF
+    r[PC] = d.pc + 4
+
+
+def op_slli(m, d):
+    r = m.regs
+    r[d.rd] = (r[d.rs1] << d.imm) & 0xFFFFFFFF
+    r[PC] = d.pc + 4
+
+
+def op_srli(m, d):
+    # zero extend (logical right shift)
+    r = m.regs
+    r[d.rd] = r[d.rs1] >> d.imm
+    r[PC] = d.pc + 4
+
+
+def op_srai(m, d):
+    # sign-extend (arithmetic right shift)
+    r = m.regs
+    r[d.rd] = (((r[d.rs1] ^ 0x80000000) - 0x80000000) >> d.imm) & 0xFFFFFFFF
+    r[PC] = d.pc + 4
+
+
+def op_add(m, d):
+    r = m.regs
+    r[d.rd] = (r[d.rs1] + r[d.rs2]) & 0xFFFFFFFF
+    r[PC] = d.pc + 4
+
+
+def op_sub(m, d):
+    r = m.regs
+    r[d.rd] = (r[d.rs1] - r[d.rs2]) & 0xFFFFFFFF
+    r[PC] = d.pc + 4
+
+
+def op_slt(m, d):
+    r = m.regs
+    r[d.rd] = int((r[d.rs1] ^ 0x80000000) < (r[d.rs2] ^ 0x80000000))
+    r[PC] = d.pc + 4
+
+
+def op_sltu(m, d):
+    r = m.regs
+    r[d.rd] = int(r[d.rs1] < r[d.rs2])
+    r[PC] = d.pc + 4
+
+
+def op_and(m, d):
+    r = m.regs
+    r[d.rd] = r[d.rs1] & r[d.rs2]
+    r[PC] = d.pc + 4
+
+
+def op_or(m, d):
+    r = m.regs
+    r[d.rd] = r[d.rs1] | r[d.rs2]
+    r[PC] = d.pc + 4
+
+
+def op_xor(m, d):
+    r = m.regs
+    r[d.rd] = r[d.rs1] ^ r[d.rs2]
+    r[PC] = d.pc + 4
+
+
+def op_sll(m, d):
+    r = m.regs
+    r[d.rd] = (r[d.rs1] << (r[d.rs2] & 0x1f)) & 0xFFFFFFFF
+    r[PC] = d.pc + 4
+
+
+def op_srl(m, d):
+    r = m.regs
+    r[d.rd] = r[d.rs1] >> (r[d.rs2] & 0x1f)
+    r[PC] = d.pc + 4
+
+
+def op_sra(m, d):
+    # sign-extend (arithmetic right shift)
+    r = m.regs
+    r[d.rd] = (((r[d.rs1] ^ 0x80000000) - 0x80000000) >> (r[d.rs2] & 0x1f)) & 0xFFFFFFFF
+    r[PC] = d.pc + 4
+
+
+def op_ecall(m, d):
+    # there is no environment to call; Machine.run() stops after it
+    m.regs[PC] = d.pc + 4
+
+
+# csr*: the register forms take the operand from rs1, the immediate forms
+# take the rs1 field itself. imm is the CSR number.
+
+def csrrw(m, d, value):
+    r = m.regs
+    if (d.rd != 0):
+        r[d.rd] = m.csr_read(d.imm)
+    m.csr_write(d.imm, value)
+    r[PC] = d.pc + 4
+
+
+def csrrs(m, d, value):
+    r = m.regs
+    old = m.csr_read(d.imm)
+    if (d.rs1 != 0):
+        m.csr_write(d.imm, old | value)
+    r[d.rd] = old
+    r[PC] = d.pc + 4
+
+
+def csrrc(m, d, value):
+    r = m.regs
+    old = m.csr_read(d.imm)
+    if (d.rs1 != 0):
+        m.csr_write(d.imm, old & ~value)
+    r[d.rd] = old
+    r[PC] = d.pc + 4
+
+
+def op_csrrw(m, d):
+    csrrw(m, d, m.regs[d.rs1])
+
+
+def op_csrrs(m, d):
+    csrrs(m, d, m.regs[d.rs1])
+
+
+def op_csrrc(m, d):
+    csrrc(m, d, m.regs[d.rs1])
+
+
+def op_csrrwi(m, d):
+    csrrw(m, d, d.rs1)
+
+
+def op_csrrsi(m, d):
+    csrrs(m, d, d.rs1)
+
+
+def op_csrrci(m, d):
+    csrrc(m, d, d.rs1)
+
+
+def op_skip(m, d):
+    # not implemented yet (ebreak, mret), skipped quietly; Machine.run()
+    # can stop at ebreak instead
+    m.regs[PC] = d.pc + 4
+
+
+def op_fence(m, d):
+    # one hart, and stores invalidate cached code themselves
+    m.regs[PC] = d.pc + 4
+
+
+# *** Fused pairs ***
+# Adjacent instruction pairs that Machine.run() executes as one operation.
+# Each handler counts itself in m.fused, which is how run() knows how many
+# instructions its loop retired, see run_fused().
+
+FUSED = ["lui+addi", "auipc+jalr", "slli+srli"]
+
+
+def op_lui_addi(m, d):
+    # lui rd, hi; addi rd, rd, lo; imm is the constant
+    r = m.regs
+    r[d.rd] = d.imm
+    r[PC] = d.pc + 8
+    m.fused[0] += 1
+
+
+def op_auipc_jalr(m, d):
+    # auipc rs1, hi; jalr rd, lo(rs1); imm2 is pc + hi, imm the target
+    r = m.regs
+    r[d.rs1] = d.imm2
+    r[d.rd] = d.pc + 8
+    r[PC] = d.imm
+    m.fused[1] += 1
+
+
+def op_slli_srli(m, d):
+    # slli rd, rs1, imm; srli rd, rd, imm2
+    r = m.regs
+    r[d.rd] = ((r[d.rs1] << d.imm) & 0xFFFFFFFF) >> d.imm2
+    r[PC] = d.pc + 8
+    m.fused[2] += 1
+
+
+def fuse(d, e):
+    # the fused Insn for d followed by e, or None. Only pairs where the
+    # second instruction consumes the first one's result qualify; a jump to
+    # the second one still finds it decoded on its own.
+    if (d.rd == 0 or e.rs1 != d.rd):
+        return None
+    if (d.name == "lui" and e.name == "addi" and e.rd == d.rd):
+        return Insn(d.pc, d.word, "lui+addi", op_lui_addi, d.rd, imm=(d.imm + e.imm) & 0xFFFFFFFF)
+    if (d.name == "auipc" and e.name == "jalr"):
+        return Insn(d.pc, d.word, "auipc+jalr", op_auipc_jalr, e.rd, d.rd,
+                    imm=(d.imm + e.imm) & 0xFFFFFFFE, imm2=d.imm)
+    if (d.name == "slli" and e.name == "srli" and e.rd == d.rd):
+        return Insn(d.pc, d.word, "slli+srli", op_slli_srli, d.rd, d.rs1, imm=d.imm, imm2=e.imm)
+    return None
+
+
+# *** Decode ***
+
+HANDLERS = {
+    # auipc's pc-relative value is folded at decode time
+    "lui": op_lui, "auipc": op_lui, "jal": op_jal, "jalr": op_jalr,
+    "beq": op_beq, "bne": op_bne, "blt": op_blt,
+    "bge": op_bge, "bltu": op_bltu, "bgeu": op_bgeu,
+    "lb": op_lb, "lh": op_lh, "lw": op_lw, "lbu": op_lbu, "lhu": op_lhu,
+    "sb": op_sb, "sh": op_sh, "sw": op_sw,
+    "addi": op_addi, "slti": op_slti, "sltiu": op_sltiu,
+    "xori": op_xori, "ori": op_ori, "andi": op_andi,
+    "slli": op_slli, "srli": op_srli, "srai": op_srai,
+    "add": op_add, "sub": op_sub, "sll": op_sll, "slt": op_slt, "sltu": op_sltu,
+    "xor": op_xor, "srl": op_srl, "sra": op_sra, "or": op_or, "and": op_and,
+    "ecall": op_ecall, "ebreak": op_skip, "mret": op_skip,
+    "csrrw": op_csrrw, "csrrs": op_csrrs, "csrrc": op_csrrc,
+    "csrrwi": op_csrrwi, "csrrsi": op_csrrsi, "csrrci": op_csrrci,
+    "fence": op_fence, "fence.i": op_fence,
+}
+
+
+def entry(name, fn):
+    # (name, immediate decoder, pc-relative, handler, rd/rs1/rs2 masks);
+    # pc-relative immediates are turned into absolute targets
+    pcrel = name == "auipc" or isa.INSTR[name]["type"] in ("B", "J")
+    masks = tuple(0x1f if used else 0 for used in isa.operands(name))
+    return (name, isa.immediate(name), pcrel, fn) + masks
+
+
+# indexed by raw opcode/funct3/funct7, see isa.index()
+DISPATCH = isa.table({name: entry(name, fn) for name, fn in HANDLERS.items()})
+
+
+def decode(pc, instruction):
+    e = isa.lookup(DISPATCH, instruction)
+    if (e is None):
+        raise Exception("illegal instruction 0x%08x at 0x%x" % (instruction, pc))
+    name, immediate, pcrel, fn, rd, rs1, rs2 = e
+    imm = immediate(instruction)
+    if (pcrel):
+        imm = (pc + imm) & 0xFFFFFFFF
+    return Insn(pc, instruction, name, fn, (instruction >> 7) & rd,
+                (instruction >> 15) & rs1, (instruction >> 20) & rs2, imm)
+
+
+class Machine:
+    # One hart with its own registers, memory and caches. Any number of
+    # machines can live in one process.
+
+    def __init__(self):
+        self.regfile = Regfile()
+        self.regs = self.regfile.regs
+        # sparse 32-bit address space, pages allocated on demand
+        self.memory = Memory()
+        # pc -> Insn
+        self.decode_cache = {}
+        # pc -> Insn or fused pair, for run()
+        self.fused_cache = {}
+        # times each of FUSED ran
+        self.fused = [0] * len(FUSED)
+        self.blocks = None
+        # tracing.Trace; tracing is off while this is None
+        self.trace = None
+        # tracing.Histogram; counts executed instructions while set
+        self.histogram = None
+        # instructions retired before the current run(); cycles are counted
+        # as one per instruction
+        self.instret = 0
+        # [iterator, size, base] of the current run_fused() round, which
+        # counts its iterations in the iterator instead of in the loop
+        self.running = None
+        # mcycle/minstret minus the retired count; set by writes to them
+        self.cycle_offset = 0
+        self.instret_offset = 0
+        self.start_time = time.perf_counter()
+        # other CSRs, read back as written
+        self.csrs = {}
+        # pcs run() stops at; change with add/remove_breakpoint()
+        self.breakpoints = set()
+        # Snapshot reset() goes back to, see mark()
+        self.pristine = None
+
+    def load(self, addr, data):
+        self.memory.load(addr, data)
+        self.invalidate(addr, len(data))
+
+    def load_elf(self, f):
+        # map every PT_LOAD segment and start at the entry point
+        entry, segments = loader.load_elf(self.memory, f)
+        for addr, size in segments:
+            self.invalidate(addr, size)
+        self.regs[PC] = entry
+        self.mark()
+
+    def fetch(self, addr):
+        return self.memory.read32(addr)
+
+    def invalidate(self, addr, length):
+        # drop cached decodes of any word overlapping [addr, addr + length)
+        decode_cache = self.decode_cache
+        if (length > len(decode_cache)):
+            stale = [pc for pc in decode_cache if addr - 4 < pc < addr + length]
+        else:
+            stale = range(addr - 3, addr + length)
+        for pc in stale:
+            decode_cache.pop(pc, None)
+        # fused pairs span 8 bytes
+        fused_cache = self.fused_cache
+        if (length > len(fused_cache)):
+            stale = [pc for pc in fused_cache if addr - 8 < pc < addr + length]
+        else:
+            stale = range(addr - 7, addr + length)
+        for pc in stale:
+            fused_cache.pop(pc, None)
+        if (self.blocks is not None):
+            self.blocks.invalidate(addr, length)
+
+    def retired(self):
+        # instructions retired so far, including the current run() up to
+        # (not including) the instruction being executed
+        if (self.running is None):
+            return self.instret
+        it, size, base = self.running
+        return base + sum(self.fused) + size - operator.length_hint(it) - 1
+
+    def csr_read(self, csr):
+        low = csr & ~0x80
+        if (low == CYCLE or low == MCYCLE):
+            value = self.retired() + self.cycle_offset
+        elif (low == INSTRET or low == MINSTRET):
+            value = self.retired() + self.instret_offset
+        elif (low == TIME):
+            value = int((time.perf_counter() - self.start_time) * TIME_HZ)
         else:
-            raise Exception("write funct3 %r" % funct3)
-
-    elif (opcode == OP.OP):
-        rd = extractBits(instruction, 11, 7)
-        funct3 = FUNCT3(extractBits(instruction, 14, 12))
-        rs1 = extractBits(instruction, 19, 15)
-        rs2 = extractBits(instruction, 24, 20)
-        funct7 = extractBits(instruction, 31, 25)
-        if (funct3 == FUNCT3.ADD and funct7 == 0b0000000):
-            regfile[rd] = regfile[rs1] + regfile[rs2]
-        elif (funct3 == FUNCT3.SLT and funct7 == 0b0000000):
-            if (sign_extend(regfile[rs1]) < sign_extend(regfile[rs2])):
-                regfile[rd] = 1
+            return self.csrs.get(csr, 0)
+        return (value >> 32 if csr & 0x80 else value) & 0xFFFFFFFF
+
+    def csr_write(self, csr, value):
+        low = csr & ~0x80
+        if (low == MCYCLE or low == MINSTRET):
+            # the write takes effect after the writing instruction retires
+            retired = self.retired() + 1
+            offset = self.cycle_offset if low == MCYCLE else self.instret_offset
+            old = retired + offset
+            if (csr & 0x80):
+                new = (old & 0xFFFFFFFF) | value << 32
             else:
-                regfile[rd] = 0
-        elif (funct3 == FUNCT3.SLTU and funct7 == 0b0000000):
-            if (regfile[rs1] < regfile[rs2]):
-                regfile[rd] = 1
+                new = (old & ~0xFFFFFFFF) | value
+            # counters are 64 bits, and so are the offsets, as unsigned
+            if (low == MCYCLE):
+                self.cycle_offset = (new - retired) & 0xFFFFFFFFFFFFFFFF
             else:
-                regfile[rd] = 0
-        elif (funct3 == FUNCT3.AND and funct7 == 0b0000000):
-            regfile[rd] = regfile[rs1] & regfile[rs2]
-        elif (funct3 == FUNCT3.OR and funct7 == 0b0000000):
-            regfile[rd] = regfile[rs1] | regfile[rs2]
-        elif (funct3 == FUNCT3.XOR and funct7 == 0b0000000):
-            regfile[rd] = regfile[rs1] ^ regfile[rs2]
-        elif (funct3 == FUNCT3.SLL and funct7 == 0b0000000):
-            shift = regfile[rs2] & 0x1f
-            regfile[rd] = regfile[rs1] << shift
-        elif (funct3 == FUNCT3.SRL and funct7 == 0b0000000):
-            shift = regfile[rs2] & 0x1f
-            regfile[rd] = regfile[rs1] >> shift
-        elif (funct3 == FUNCT3.SUB and funct7 == 0b0100000):
-            regfile[rd] = regfile[rs1] - regfile[rs2]
-        elif (funct3 == FUNCT3.SRA and funct7 == 0b0100000):
-            # sign-extend (arithmetic right shift)
-            shift = regfile[rs2] & 0x1f
-            sb = regfile[rs1] >> 31
-            regfile[rd] = regfile[rs1] >> shift
-            regfile[rd] |= (0xffffffff * sb) << (32 - shift)
-        else:
-            raise Exception("write %r %r %r" % (opcode, funct3, hex(funct12)))
-
-    elif (opcode == OP.SYSTEM):
-        rd = extractBits(instruction, 11, 7)
-        funct3 = FUNCT3(extractBits(instruction, 14, 12))
-        rs1 = extractBits(instruction, 19, 15)
-        funct12 = extractBits(instruction, 31, 20)
-        trap_ret = extractBits(instruction, 31, 25)
-        if (funct3 == FUNCT3.ECALL and funct12 == 0x0):
-            if (regfile[3] > 1):
-                print("     ecall", regfile[3])
-                raise Exception("Test failed")
-        elif (funct3 == FUNCT3.EBREAK and funct12 == 0x1):
-            print("ebreak")
-        elif (funct3 == FUNCT3.CSRRW):
-            print("csrrw")
-        elif (funct3 == FUNCT3.CSRRS):
-            print("csrrs")
-        elif (funct3 == FUNCT3.CSRRC):
-            print("csrrc")
-        elif (funct3 == FUNCT3.CSRRWI):
-            print("csrrwi")
-        elif (funct3 == FUNCT3.CSRRSI):
-            print("csrrsi")
-        elif (funct3 == FUNCT3.CSRRCI):
-            print("csrrci")
-        elif (funct3 == FUNCT3.MRAT and trap_ret == 0b0011000):
-            # TODO: could be handled differently in an actual system
-            print("mrat")
+                self.instret_offset = (new - retired) & 0xFFFFFFFFFFFFFFFF
+        elif (csr >> 10 != 3):
+            # 0xC00-0xFFF are read-only
+            self.csrs[csr] = value
+
+    def snapshot(self):
+        # memory pages are shared with the snapshot until either side
+        # writes them
+        return Snapshot(list(self.regs), self.retired(), self.cycle_offset, self.instret_offset,
+                        dict(self.csrs), self.memory.snapshot())
+
+    def restore(self, s):
+        # O(pages dirtied since the last snapshot) when s is that snapshot
+        self.regs[:] = s.regs
+        self.instret = s.instret
+        self.cycle_offset = s.cycle_offset
+        self.instret_offset = s.instret_offset
+        self.csrs = dict(s.csrs)
+        changed = self.memory.restore(s.memory)
+        if (changed is None):
+            self.decode_cache.clear()
+            self.fused_cache.clear()
+            if (self.blocks is not None):
+                self.blocks.clear()
+            return
+        for pn in changed:
+            self.invalidate(pn << PAGE_SHIFT, PAGE_SIZE)
+
+    def mark(self):
+        # make the current state the one reset() returns to; load_elf()
+        # marks the freshly loaded image
+        self.pristine = self.snapshot()
+
+    def reset(self):
+        # back to the last mark(), restoring only the pages written since
+        # and keeping every cache for the rest. Taking another snapshot()
+        # in between makes the next reset() restore all pages.
+        if (self.pristine is None):
+            raise Exception("no reset point")
+        self.restore(self.pristine)
+
+    def decode_at(self, pc):
+        d = self.decode_cache.get(pc)
+        if (d is None):
+            # fetch
+            instruction = self.fetch(pc)
+            if (instruction == 0):
+                return None
+            # decode
+            d = decode(pc, instruction)
+            self.decode_cache[pc] = d
+        return d
+
+    def decode_fused(self, pc):
+        # what run() executes at pc: the Insn there, or the fused pair it
+        # starts. Both words stay in decode_cache, so stores to either one
+        # are noticed and invalidate the pair.
+        d = self.decode_at(pc)
+        if (d is None):
+            return None
+        if (d.name in ("lui", "auipc", "slli") and (pc + 4) & 0xFFFFFFFF not in self.breakpoints):
+            try:
+                e = self.decode_at((pc + 4) & 0xFFFFFFFF)
+            except Exception:
+                e = None
+            if (e is not None):
+                d = fuse(d, e) or d
+        if (d.name not in STOPS and pc not in self.breakpoints):
+            self.fused_cache[pc] = d
+        return d
+
+    def add_breakpoint(self, pc):
+        self.breakpoints.add(pc)
+        # neither cached on its own nor as the second half of a pair
+        self.fused_cache.pop(pc, None)
+        self.fused_cache.pop((pc - 4) & 0xFFFFFFFF, None)
+
+    def remove_breakpoint(self, pc):
+        self.breakpoints.discard(pc)
+
+    def fusion_counts(self):
+        return dict(zip(FUSED, self.fused))
+
+    def step(self):
+        # execute one instruction; returns its Insn, or None at a zero word
+        r = self.regs
+        d = self.decode_cache.get(r[PC]) or self.decode_at(r[PC])
+        if (d is not None):
+            if (self.trace is not None or self.histogram is not None):
+                self.run_traced(1)
+            else:
+                d.fn(self, d)
+                r[0] = 0
+                self.instret += 1
+        return d
+
+    def run(self, max_instructions, stop_on=STOP_ON):
+        # execute up to max_instructions and return a RunResult. Execution
+        # stops in front of any instruction named in stop_on, and, with
+        # BREAKPOINT in stop_on, at the breakpoints, except at the
+        # instruction it starts at: calling run() again goes on past the
+        # stop. An ecall that is not in stop_on runs and stops it as ECALL. A zero word halts it; an exception stops it as a fault.
+        # Stopping at instructions other than STOPS checks every
+        # instruction, as tracing does.
+        unknown = set(stop_on) - set(HANDLERS) - {BREAKPOINT}
+        if (unknown):
+            raise ValueError("can't stop at %s" % ", ".join(sorted(unknown)))
+        start = self.instret
+        began = time.perf_counter()
+        error = None
+        try:
+            if (self.trace is not None or self.histogram is not None or not set(stop_on) <= set(STOP_ON)):
+                reason = self.run_traced(max_instructions, stop_on)
+            else:
+                reason = self.run_fused(max_instructions, stop_on)
+        except Exception as e:
+            reason = FAULT
+            error = e
+        return RunResult(reason, self.instret - start, time.perf_counter() - began, self.regs[PC], error)
+
+    def run_fused(self, n, stop_on):
+        # run()'s loop; returns the stop reason. Instructions it may stop at
+        # are never in fused_cache, so it only checks for them on a miss.
+        # A pair retires two instructions in one iteration, so the loop runs
+        # in rounds of half the instructions left (pairs are told apart by
+        # what they add to m.fused) and the last one runs on its own.
+        r = self.regs
+        fused_cache = self.fused_cache
+        fused = self.fused
+        start = self.instret
+        try:
+            while n - (self.instret - start) > 1:
+                size = (n - (self.instret - start)) >> 1
+                it = iter(range(size))
+                self.running = [it, size, self.instret - sum(fused)]
+                for _ in it:
+                    d = fused_cache.get(r[PC])
+                    if (d is None):
+                        d = self.decode_fused(r[PC])
+                        reason = self.stop_reason(d, stop_on, self.retired() == start)
+                        if (reason is not None):
+                            self.instret = self.retired()
+                            return reason
+                        if (d.name == ECALL and ECALL not in stop_on):
+                            d.fn(self, d)
+                            self.instret = self.retired() + 1
+                            return ECALL
+                    d.fn(self, d)
+                    r[0] = 0
+                # every iteration ran, all of them retired
+                self.instret = self.running[2] + sum(fused) + size
+        except BaseException:
+            self.instret = self.retired()
+            raise
+        finally:
+            self.running = None
+        if (self.instret - start < n):
+            return self.run_traced(1, stop_on, self.instret == start)
+        return LIMIT
+
+    def stop_reason(self, d, stop_on, first):
+        # why run() stops in front of d, or None; first is whether d would be
+        # the first instruction of the run, which it never stops at, so the
+        # next run() goes on from where the last one stopped
+        if (d is None):
+            return HALT
+        if (first):
+            return None
+        if (d.name in stop_on):
+            return d.name
+        if (d.pc in self.breakpoints and BREAKPOINT in stop_on):
+            return BREAKPOINT
+        return None
+
+    def run_traced(self, n, stop_on=(), first=True):
+        # run() with a trace record and/or a histogram count per
+        # instruction (one by one without either); returns the stop reason
+        r = self.regs
+        trace = self.trace
+        histogram = self.histogram
+        for i in range(n):
+            d = self.decode_at(r[PC])
+            reason = self.stop_reason(d, stop_on, first and i == 0)
+            if (reason is not None):
+                return reason
+            if (trace is not None):
+                if (d.name in LOADS or d.name in STORES):
+                    addr = (r[d.rs1] + d.imm) & 0xFFFFFFFF
+                else:
+                    addr = 0
+            d.fn(self, d)
+            r[0] = 0
+            self.instret += 1
+            if (trace is not None):
+                trace.append(d.pc, d.word, d.rd, r[d.rs2] if d.name in STORES else r[d.rd], addr)
+            if (histogram is not None):
+                histogram.add(d.word)
+            if (d.name == ECALL and ECALL not in stop_on):
+                return ECALL
+        return LIMIT
+
+    def run_blocks(self, limit=sys.maxsize):
+        # translate and run whole basic blocks instead of single
+        # instructions, up to limit instructions; returns the number of
+        # instructions executed. Blocks don't trace, so tracing falls back
+        # to the interpreter, as does a block that would go over the limit.
+        # Either way it runs through ecalls up to a zero word. CSR
+        # instructions are blocks of their own, so instret is exact
+        # whenever one runs. Linked blocks hand back their successor, the
+        # cache is only consulted on unlinked exits (see jit.py).
+        start = self.instret
+        if (self.trace is None and self.histogram is None):
+            if (self.blocks is None):
+                self.blocks = BlockCache(self.decode_at)
+            blocks = self.blocks
+            r = self.regs
+            left = limit
+            b = blocks.get(r[PC])
+            while b is not None and b.n <= left:
+                nb = b.fn(self, r)
+                self.instret += b.n
+                left -= b.n
+                b = nb if nb is not None else blocks.link(b, r[PC])
+            if (b is None):
+                return self.instret - start
+        # run_traced() returns after an ecall
+        while (self.run_traced(limit - (self.instret - start)) == ECALL):
             pass
-        else:
-            raise Exception("write %r %r %r" % (opcode, funct3, hex(funct12)))
-
-    elif (opcode == OP.BRANCH):
-        funct3 = FUNCT3(extractBits(instruction, 14, 12))
-        rs1 = extractBits(instruction, 19, 15)
-        rs2 = extractBits(instruction, 24, 20)
-        imm = extractBits(
-            instruction, 32, 31) << 12 | extractBits(instruction, 30, 25) << 5 | extractBits(instruction, 11, 8) << 1 | extractBits(instruction, 8, 7) << 11
-        offset = sign_extend(imm, 13)
-        cond = False
-        if (funct3 == FUNCT3.BEQ):
-            cond = regfile[rs1] == regfile[rs2]
-        elif (funct3 == FUNCT3.BNE):
-            cond = regfile[rs1] != regfile[rs2]
-        elif (funct3 == FUNCT3.BLT):
-            cond = sign_extend(regfile[rs1], 32) < sign_extend(
-                regfile[rs2], 32)
-        elif (funct3 == FUNCT3.BGE):
-            print("bge")
-        elif (funct3 == FUNCT3.BLTU):
-            cond = regfile[rs1] < regfile[rs2]
-        elif (funct3 == FUNCT3.BGEU):
-            print("bgeu")
-        else:
-            raise Exception("write funct3 %r" % funct3)
-        if (cond):
-            regfile[PC] += offset
-            return True
-
-    elif (opcode == OP.AUIPC):
-        # U-type instruction
-        rd = extractBits(instruction, 11, 7)
-        imm = extractBits(instruction, 31, 12)
-        offset = imm << 12
-        regfile[rd] = regfile[PC] + offset
-
-    elif (opcode == OP.LUI):
-        # U-type instruction
-        rd = extractBits(instruction, 11, 7)
-        imm = extractBits(instruction, 31, 12)
-        constant = imm << 12
-        regfile[rd] = constant
-
-    elif (opcode == OP.MISC_MEM):
-        print("misc-mem")
-
-    elif (opcode == OP.LOAD):
-        # I-type instruction
-        rd = extractBits(instruction, 11, 7)
-        funct3 = FUNCT3(extractBits(instruction, 14, 12))
-        rs1 = extractBits(instruction, 19, 15)
-        imm = extractBits(instruction, 31, 20)
-        value = sign_extend(imm, 12)
-        addr = regfile[rs1] + value
-        # value = sign_extend(imm, 12)
-        if (funct3 == FUNCT3.LB):
-            regfile[rd] = sign_extend(fetch(addr) & 0xff, 8)
-        elif (funct3 == FUNCT3.LBU):
-            regfile[rd] = fetch(addr) & 0xff
-        elif (funct3 == FUNCT3.LH):
-            regfile[rd] = sign_extend(fetch(addr) & 0xffff, 16)
-        elif (funct3 == FUNCT3.LHU):
-            regfile[rd] = fetch(addr) & 0xffff
-        elif (funct3 == FUNCT3.LW):
-            regfile[rd] = fetch(addr)
-        else:
-            raise Exception("write funct3 %r" % funct3)
+        return self.instret - start
 
-    elif (opcode == OP.STORE):
-        print("store")
+    def dump(self):
+        pp = []
+        for i in range(33):
+            if i != 0 and i % 8 == 0:
+                pp += "\n"
+            pp += " %3s: %08x" % (regnames[i], self.regs[i])
+        print(''.join(pp))
 
-    else:
-        dump()
-        raise Exception("write opcode %r" % opcode)
 
-    print("{:<12} {:<12} {:<10}".format(
-        hex(regfile[PC]), hex(instruction), opcode))
+# The module-level functions drive one default machine.
 
-    dump()
-    regfile[PC] += 0x4
-    return True
+machine = None
+memory = None
+regfile = None
+
+
+def init():
+    global machine, memory, regfile
+    machine = Machine()
+    memory = machine.memory
+    regfile = machine.regfile
+
+
+def reset():
+    # init() for a rerun of the same ELF: only what changed is restored
+    machine.reset()
+
+
+def load(addr, data):
+    machine.load(addr, data)
+
+
+def fetch(addr):
+    return machine.fetch(addr)
+
+
+def dump():
+    machine.dump()
+
+
+def process():
+    return machine.step() is not None
+
+
+def run_blocks():
+    return machine.run_blocks()
 
 
 def extractBits(instruction, start, end):
@@ -365,6 +892,11 @@ def extractBits(instruction, start, end):
 
 
 def main():
+    # ./cpu1.py [--jit] [--trace] [--histogram]; --trace writes <test>.trace
+    # next to each test, pretty-print it with ./tracing.py
+    jit = "--jit" in sys.argv[1:]
+    tracing = "--trace" in sys.argv[1:]
+    histogram = "--histogram" in sys.argv[1:]
     for x in glob.glob("/home/adam/dev/riscv-tests/isa/rv32ui-p-jal"):
         if (x.endswith('.dump')):
             continue
@@ -372,17 +904,28 @@ def main():
             # readelf(["readelf", x, "-e"])
             print("test", x)
             init()
-            elffile = ELFFile(f)
-            for segment in elffile.iter_segments():
-                if (segment.header.p_paddr < 0x80000000):
-                    continue
-                load(segment.header.p_paddr, segment.data())
-            regfile[PC] = 0x80000000
+            machine.load_elf(f)
+            uart = UART()
+            memory.attach(UART_BASE, PAGE_SIZE, uart)
+            if (tracing):
+                machine.trace = Trace()
+            if (histogram):
+                machine.histogram = Histogram()
             instrcnt = 0
 
-            while process():
-                instrcnt += 1
+            if (jit):
+                instrcnt = run_blocks()
+            else:
+                while process():
+                    instrcnt += 1
+            uart.flush()
             print("run %d instructions" % instrcnt)
+            dump()
+            if (histogram):
+                print(machine.histogram.report())
+            if (tracing):
+                with open(x + ".trace", "wb") as t:
+                    machine.trace.save(t)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+
+# RV32I disassembler. Mnemonics come from the flat (opcode, funct3, funct7)
+# index generated from isa.INSTR, so add/sub, srli/srai etc. are told apart
+# with one list lookup. Rendered words are kept in an LRU cache; branch and
+# jump targets depend on the pc and are filled in afterwards, so the same
+# word at different addresses still hits the cache.
+#
+#   ./disasm.py prog.elf ...     disassemble the executable sections with symbol labels
+
+import functools
+import sys
+
+import elf
+import isa
+from isa import regnames, LOADS
+
+# indexed like isa.table(), mnemonic or None
+NAMES = isa.table({name: name for name in isa.INSTR})
+DECODERS = {name: isa.immediate(name) for name in isa.INSTR}
+CACHE_SIZE = 1 << 16
+# csrrw x0, cycle, x0: cycle is read-only, so this is the canonical illegal
+# instruction
+UNIMP = 0xc0001073
+
+
+def mnemonic(word):
+    return isa.lookup(NAMES, word)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def render(word):
+    # (text, pc-relative offset or None); with an offset, the text ends
+    # where the target goes
+    name = mnemonic(word)
+    if (word == UNIMP):
+        return "unimp", None
+    if (name is None):
+        return ".word   0x%08x" % word, None
+    spec = isa.INSTR[name]
+    t = spec["type"]
+    rd = regnames[(word >> 7) & 0x1f]
+    rs1 = regnames[(word >> 15) & 0x1f]
+    rs2 = regnames[(word >> 20) & 0x1f]
+    imm = DECODERS[name](word)
+    if ("funct12" in spec or spec["opcode"] == 0b0001111):
+        return name, None
+    if (t == "R"):
+        return "%-7s %s, %s, %s" % (name, rd, rs1, rs2), None
+    if (t == "U"):
+        return "%-7s %s, 0x%x" % (name, rd, imm >> 12), None
+    if (t == "J"):
+        return "%-7s %s, " % (name, rd), imm
+    if (t == "B"):
+        return "%-7s %s, %s, " % (name, rs1, rs2), imm
+    if (t == "S"):
+        return "%-7s %s, %d(%s)" % (name, rs2, imm, rs1), None
+    if (name in LOADS or name == "jalr"):
+        return "%-7s %s, %d(%s)" % (name, rd, imm, rs1), None
+    if (spec["opcode"] == isa.SYSTEM):
+        csr = isa.CSRS.get(imm, "0x%03x" % imm)
+        if (name.endswith("i")):
+            return "%-7s %s, %s, %d" % (name, rd, csr, (word >> 15) & 0x1f), None
+        return "%-7s %s, %s, %s" % (name, rd, csr, rs1), None
+    return "%-7s %s, %s, %d" % (name, rd, rs1, imm), None
+
+
+def disasm(word, pc=0, symbols=None):
+    # one instruction; symbols (address -> name) labels branch targets
+    text, offset = render(word)
+    if (offset is None):
+        return text
+    target = (pc + offset) & 0xFFFFFFFF
+    if (symbols and target in symbols):
+        return text + "%x <%s>" % (target, symbols[target])
+    return text + "%x" % target
+
+
+def symbols(e):
+    # address -> name of the code symbols of an elf.ELF
+    out = {}
+    for sym in e.symbols:
+        if (not sym.name or sym.name.startswith(("$", ".L")) or sym.st_shndx == elf.SHN_UNDEF):
+            continue
+        if (sym.type in (elf.STT_FUNC, elf.STT_NOTYPE)):
+            out.setdefault(sym.st_value, sym.name)
+    return out
+
+
+def disassemble_elf(f):
+    # yields the listing line by line, like objdump -d
+    e = elf.read(f)
+    labels = symbols(e)
+    for section in e.sections:
+        if (not section.sh_flags & elf.SHF_EXECINSTR):
+            continue
+        yield ""
+        yield "Disassembly of section %s:" % section.name
+        base = section.sh_addr
+        data = e.contents(section)
+        for i, word in enumerate(data[:len(data) & ~3].cast("I")):
+            pc = base + 4 * i
+            if (pc in labels):
+                yield ""
+                yield "%08x <%s>:" % (pc, labels[pc])
+            yield "%8x:\t%08x\t%s" % (pc, word, disasm(word, pc, labels))
+
+
+def main():
+    for path in sys.argv[1:]:
+        with open(path, "rb") as f:
+            print("%s:" % path)
+            for line in disassemble_elf(f):
+                print(line)
+
+
+if __name__ == '__main__':
+    main()
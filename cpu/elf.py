@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+
+# Minimal ELF reader for the emulators: ELF32 little-endian headers,
+# program headers, sections and the symbol table, read with struct from a
+# memoryview of the file, so nothing is copied and startup costs next to
+# nothing. Anything else (ELF64, big-endian) is handed to pyelftools when it
+# is installed; it is only imported then.
+#
+#   ./elf.py prog.elf ...     entry point, segments and tohost
+
+from collections import namedtuple
+import mmap
+import struct
+import sys
+
+EHDR = struct.Struct("<16sHHIIIIIHHHHHH")
+PHDR = struct.Struct("<8I")
+SHDR = struct.Struct("<10I")
+SYM = struct.Struct("<IIIBBH")
+
+MAGIC = b"\x7fELF"
+ELFCLASS32 = 1
+ELFDATA2LSB = 1
+
+PT_LOAD = 1
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+SHF_EXECINSTR = 0x4
+STT_NOTYPE, STT_OBJECT, STT_FUNC = 0, 1, 2
+SHN_UNDEF = 0
+
+Segment = namedtuple("Segment", "p_type p_offset p_vaddr p_paddr p_filesz p_memsz p_flags p_align")
+Section = namedtuple("Section", "name sh_type sh_flags sh_addr sh_offset sh_size sh_link sh_info sh_addralign "
+                                "sh_entsize")
+Symbol = namedtuple("Symbol", "name st_value st_size type bind st_shndx")
+
+
+class ELF:
+    # entry, segments, sections and symbols of an ELF file; data is a
+    # memoryview of the whole file, which segment and section contents are
+    # views of
+    def __init__(self, data, entry, segments, sections, symbols):
+        self.data = data
+        self.entry = entry
+        self.segments = segments
+        self.sections = sections
+        self.symbols = symbols
+        self.names = {s.name: s for s in symbols}
+
+    def section(self, name):
+        return next((s for s in self.sections if s.name == name), None)
+
+    def contents(self, s):
+        # file contents of a Segment or Section
+        if (isinstance(s, Segment)):
+            return self.data[s.p_offset:s.p_offset + s.p_filesz]
+        if (s.sh_type == SHT_NOBITS):
+            return self.data[0:0]
+        return self.data[s.sh_offset:s.sh_offset + s.sh_size]
+
+    def symbol(self, name):
+        # address of a defined symbol, or None
+        s = self.names.get(name)
+        return s.st_value if s is not None and s.st_shndx != SHN_UNDEF else None
+
+    @property
+    def tohost(self):
+        # where riscv-tests report their result, if they do
+        return self.symbol("tohost")
+
+
+def string(data, offset):
+    end = offset
+    while (data[end]):
+        end += 1
+    return bytes(data[offset:end]).decode("utf-8", "replace")
+
+
+def parse(data):
+    # ELF of a little-endian ELF32 image, None for other ELF classes and
+    # byte orders
+    data = memoryview(data)
+    if (len(data) < EHDR.size or data[:4] != MAGIC):
+        raise Exception("not an ELF file")
+    if (data[4] != ELFCLASS32 or data[5] != ELFDATA2LSB):
+        return None
+    (_, _, _, _, entry, phoff, shoff, _, _, phentsize, phnum, shentsize, shnum,
+     shstrndx) = EHDR.unpack_from(data, 0)
+
+    segments = [Segment._make(PHDR.unpack_from(data, phoff + i * phentsize)) for i in range(phnum)]
+
+    headers = [SHDR.unpack_from(data, shoff + i * shentsize) for i in range(shnum)]
+    names = headers[shstrndx][4] if shstrndx < shnum else None
+    sections = [Section(string(data, names + h[0]) if names is not None else "", *h[1:]) for h in headers]
+
+    symbols = []
+    for s in sections:
+        if (s.sh_type != SHT_SYMTAB):
+            continue
+        strtab = sections[s.sh_link].sh_offset
+        for off in range(s.sh_offset, s.sh_offset + s.sh_size, s.sh_entsize or SYM.size):
+            name, value, size, info, _, shndx = SYM.unpack_from(data, off)
+            symbols.append(Symbol(string(data, strtab + name), value, size, info & 0xF, info >> 4, shndx))
+    return ELF(data, entry, segments, sections, symbols)
+
+
+def parse_elftools(f, data):
+    # the same through pyelftools, for the files parse() leaves out
+    try:
+        from elftools.elf.elffile import ELFFile
+        from elftools.elf.enums import (ENUM_P_TYPE_BASE, ENUM_SH_TYPE_BASE, ENUM_ST_INFO_TYPE,
+                                        ENUM_ST_INFO_BIND, ENUM_ST_SHNDX)
+    except ImportError:
+        raise Exception("only ELF32 little-endian files are supported without pyelftools")
+
+    def number(enum, value):
+        return enum.get(value, 0) if isinstance(value, str) else value
+
+    elffile = ELFFile(f)
+    segments = []
+    for segment in elffile.iter_segments():
+        h = segment.header
+        segments.append(Segment(number(ENUM_P_TYPE_BASE, h.p_type), h.p_offset, h.p_vaddr, h.p_paddr,
+                                h.p_filesz, h.p_memsz, h.p_flags, h.p_align))
+    sections = []
+    symbols = []
+    for section in elffile.iter_sections():
+        h = section.header
+        sections.append(Section(section.name, number(ENUM_SH_TYPE_BASE, h.sh_type), h.sh_flags, h.sh_addr,
+                                h.sh_offset, h.sh_size, h.sh_link, h.sh_info, h.sh_addralign, h.sh_entsize))
+        if (h.sh_type != "SHT_SYMTAB"):
+            continue
+        for sym in section.iter_symbols():
+            info = sym["st_info"]
+            symbols.append(Symbol(sym.name, sym["st_value"], sym["st_size"],
+                                  number(ENUM_ST_INFO_TYPE, info["type"]), number(ENUM_ST_INFO_BIND, info["bind"]),
+                                  number(ENUM_ST_SHNDX, sym["st_shndx"])))
+    return ELF(data, elffile.header.e_entry, segments, sections, symbols)
+
+
+def read(f):
+    # ELF of an open binary file, mmap'd read-only when it has a file
+    # descriptor
+    try:
+        data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    except (AttributeError, OSError, ValueError):
+        f.seek(0)
+        data = memoryview(f.read())
+    e = parse(data)
+    if (e is None):
+        f.seek(0)
+        e = parse_elftools(f, data)
+    return e
+
+
+def main():
+    for path in sys.argv[1:]:
+        with open(path, "rb") as f:
+            e = read(f)
+        print("%s: entry %08x, tohost %s" % (path, e.entry,
+                                             "%08x" % e.tohost if e.tohost is not None else "-"))
+        for s in e.segments:
+            if (s.p_type == PT_LOAD):
+                print("  LOAD  %08x  filesz %6x  memsz %6x" % (s.p_paddr, s.p_filesz, s.p_memsz))
+
+
+if __name__ == '__main__':
+    main()
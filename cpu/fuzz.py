@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+
+# Random-program fuzzer. Every seed makes a random but valid RV32I program:
+# random register values, then a mix of ALU, load/store, lui/auipc, branch
+# and jal instructions. Branches and jumps only go forward, a few
+# instructions at most, so every program ends; loads and stores only use
+# s11, which points at a DATA_SIZE buffer and is never written, with
+# aligned offsets inside it. Each program runs on two engines in lockstep
+# (lockstep.compare()), and a program they disagree on is minimized by
+# dropping instructions for as long as they still disagree.
+#
+# Seeds are spread over a process pool; each worker generates, runs and
+# minimizes on its own and reports back the divergence and the minimized
+# listing. The summary groups failures by the instruction they diverged
+# at.
+#
+#   ./fuzz.py [--ref cpu1] [--engine cpu] [--seeds N] [--start S] [--length N] [-j JOBS]
+
+from multiprocessing import Pool
+import argparse
+import collections
+import os
+import random
+import re
+import sys
+
+import isa
+import lockstep
+from asm import Program
+from disasm import disasm
+
+CODE = 0x80000000
+DATA = 0x80100000
+DATA_SIZE = 2048
+# the data pointer
+BASE = 27
+MASK = 0xFFFFFFFF
+
+# how far forward a branch or jump may go, in instructions
+MAX_SKIP = 4
+# interesting register values, besides random ones
+VALUES = [0, 1, 2, 31, 32, 0x7FF, 0x800, 0x7FFFFFFF, 0x80000000, 0xFFFFFFFF, 0xFFFFF800]
+
+ALU = [n for n, x in isa.INSTR.items() if x["type"] == "R"]
+ALU_IMM = ["addi", "slti", "sltiu", "xori", "ori", "andi"]
+SHIFT_IMM = ["slli", "srli", "srai"]
+BRANCHES = [n for n, x in isa.INSTR.items() if x["type"] == "B"]
+SIZES = {"lb": 1, "lbu": 1, "lh": 2, "lhu": 2, "lw": 4, "sb": 1, "sh": 2, "sw": 4}
+REGS = [r for r in range(32) if r != BASE]
+
+
+def value(rng):
+    return rng.choice(VALUES) if rng.random() < 0.3 else rng.getrandbits(32)
+
+
+def instruction(rng):
+    # (name, rd, rs1, rs2, imm); imm of a branch or jal is how many
+    # instructions it skips
+    kind = rng.random()
+    rd, rs1, rs2 = rng.choice(REGS), rng.choice(REGS), rng.choice(REGS)
+    if (kind < 0.3):
+        return (rng.choice(ALU), rd, rs1, rs2, 0)
+    if (kind < 0.5):
+        return (rng.choice(ALU_IMM), rd, rs1, 0, rng.randrange(-2048, 2048))
+    if (kind < 0.6):
+        return (rng.choice(SHIFT_IMM), rd, rs1, 0, rng.randrange(32))
+    if (kind < 0.8):
+        name = rng.choice(list(SIZES))
+        imm = rng.randrange(DATA_SIZE // SIZES[name]) * SIZES[name]
+        if (name in isa.LOADS):
+            return (name, rd, BASE, 0, imm)
+        return (name, 0, BASE, rs2, imm)
+    if (kind < 0.85):
+        return (rng.choice(["lui", "auipc"]), rd, 0, 0, rng.getrandbits(20) << 12)
+    if (kind < 0.97):
+        return (rng.choice(BRANCHES), 0, rs1, rs2, rng.randrange(MAX_SKIP + 1))
+    return ("jal", rd, 0, 0, rng.randrange(MAX_SKIP + 1))
+
+
+def generate(seed, length):
+    # (register values, [instruction]) for a seed
+    rng = random.Random(seed)
+    regs = {r: value(rng) for r in REGS if r != 0}
+    return regs, [instruction(rng) for _ in range(length)]
+
+
+def image(regs, body):
+    # (entry, code) of a program: set up the registers, run body, stop at
+    # ecall. Forward targets past the end land on the ecall.
+    p = Program(CODE)
+    p.li(BASE, DATA)
+    for r, v in sorted(regs.items()):
+        p.li(r, v)
+    for i, (name, rd, rs1, rs2, imm) in enumerate(body):
+        p.label("i%d" % i)
+        if (isa.INSTR[name]["type"] in ("B", "J")):
+            p.op(name, rd, rs1, rs2, target="i%d" % min(len(body), i + 1 + imm))
+        else:
+            p.op(name, rd, rs1, rs2, imm)
+    p.label("i%d" % len(body))
+    p.op("ecall")
+    p.code.append(0)
+    return CODE, p.image()
+
+
+def check(ref, engine, regs, body, limit):
+    # divergence text, or None if the engines agree
+    _, _, divergence = lockstep.compare(lockstep.ENGINES[ref], lockstep.ENGINES[engine],
+                                        image(regs, body), every=limit, limit=limit)
+    return divergence
+
+
+def minimize(ref, engine, regs, body, limit):
+    # a shorter program the engines still disagree on: drop ever smaller
+    # chunks of the body, then registers the rest don't need
+    chunk = len(body) // 2
+    while chunk >= 1:
+        i = 0
+        while i < len(body):
+            shorter = body[:i] + body[i + chunk:]
+            if (shorter and check(ref, engine, regs, shorter, limit) is not None):
+                body = shorter
+            else:
+                i += chunk
+        chunk //= 2
+    for r in list(regs):
+        fewer = {k: v for k, v in regs.items() if k != r}
+        if (check(ref, engine, fewer, body, limit) is not None):
+            regs = fewer
+    return regs, body
+
+
+def listing(entry, code):
+    out = []
+    for i in range(0, len(code) - 4, 4):
+        word = int.from_bytes(code[i:i + 4], "little")
+        out.append("  %08x:  %08x  %s" % (entry + i, word, disasm(word, entry + i)))
+    return "\n".join(out)
+
+
+def run_seed(args):
+    # (seed, None) or (seed, (divergence of the minimized program, listing))
+    seed, ref, engine, length, limit = args
+    regs, body = generate(seed, length)
+    if (check(ref, engine, regs, body, limit) is None):
+        return seed, None
+    regs, body = minimize(ref, engine, regs, body, limit)
+    return seed, (check(ref, engine, regs, body, limit), listing(*image(regs, body)))
+
+
+def culprit(divergence):
+    # mnemonic of the instruction a divergence text is about
+    m = re.search(r"pc [0-9a-f]+: (\S+)", divergence or "")
+    return m.group(1) if m else "?"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fuzz two engines with random programs")
+    parser.add_argument("--ref", default="cpu1", choices=lockstep.ENGINES, help="reference engine")
+    parser.add_argument("--engine", default="cpu", choices=lockstep.ENGINES, help="engine under test")
+    parser.add_argument("--seeds", type=int, default=1000, help="programs to try")
+    parser.add_argument("--start", type=int, default=0, help="first seed")
+    parser.add_argument("--length", type=int, default=50, help="instructions per program")
+    parser.add_argument("--limit", type=int, default=100000, help="instructions per run")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("-v", "--verbose", action="store_true", help="print every minimized failure")
+    args = parser.parse_args()
+
+    cases = [(seed, args.ref, args.engine, args.length, args.limit)
+             for seed in range(args.start, args.start + args.seeds)]
+    failures = collections.defaultdict(list)
+    with Pool(args.jobs) as pool:
+        for seed, failure in pool.imap_unordered(run_seed, cases, chunksize=4):
+            if (failure is None):
+                continue
+            divergence, text = failure
+            name = culprit(divergence)
+            failures[name].append(seed)
+            if (args.verbose or len(failures[name]) == 1):
+                print("seed %d: %s\n%s\n" % (seed, divergence, text))
+    print("%d/%d seeds diverged" % (sum(len(x) for x in failures.values()), args.seeds))
+    for name, seeds in sorted(failures.items(), key=lambda x: -len(x[1])):
+        print("  %-8s %5d  e.g. seed %d" % (name, len(seeds), min(seeds)))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+
+# On-disk cache of loaded program images, keyed by a hash of the ELF's
+# contents. An entry holds what loading and decoding an ELF produces: the
+# entry point, the loadable segments as flat data, the defined symbols, and
+# every instruction of the executable segments predecoded. Entries are
+# mmap'd: segments are mapped into guest memory as views of the entry
+# (Memory.map()), and the decoded records go straight into the machine's
+# decode cache, so a hit neither parses the ELF nor decodes anything.
+#
+# The directory is $RV_CACHE, or rv32 under $XDG_CACHE_HOME (~/.cache).
+# Entries are written to a temporary file and renamed into place, so
+# concurrent runs can share it; a cache that can't be written is skipped.
+#
+#   header    magic, version, entry, segment, symbol and record counts
+#   segments  (addr, memsz, offset, filesz) each, data at offset
+#   symbols   (value, name length, name) each
+#   records   (pc, word, handler, rd, rs1, rs2, imm) each
+#
+#   ./imagecache.py prog.elf ...     fill the cache and print the entries
+
+import hashlib
+import mmap
+import os
+import struct
+import sys
+
+import cpu1
+import elf
+
+MAGIC = b"RVIC"
+VERSION = 1
+HEADER = struct.Struct("<4sIIIII")
+SEGMENT = struct.Struct("<IIII")
+SYMBOL = struct.Struct("<IH")
+RECORD = struct.Struct("<IIBBBBq")
+PF_X = 1
+
+# handler numbers in records; part of the key, so entries made with
+# another handler set are never used
+HANDLERS = sorted(cpu1.HANDLERS)
+KEY = ("%s %d %s" % (MAGIC.decode(), VERSION, " ".join(HANDLERS))).encode()
+
+
+def directory():
+    if (os.environ.get("RV_CACHE")):
+        return os.environ["RV_CACHE"]
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "rv32")
+
+
+class Image:
+    # a cache entry: entry point, [(addr, memsz, data)], symbol name ->
+    # address, and [Insn]
+    def __init__(self, entry, segments, symbols, insns):
+        self.entry = entry
+        self.segments = segments
+        self.symbols = symbols
+        self.insns = insns
+
+
+def build(data):
+    # the entry for ELF file contents
+    e = elf.parse(data)
+    if (e is None):
+        raise Exception("only ELF32 little-endian files are cached")
+    segments = []
+    insns = []
+    for s in e.segments:
+        if (s.p_type != elf.PT_LOAD or s.p_memsz == 0):
+            continue
+        contents = e.contents(s)
+        segments.append((s.p_paddr, s.p_memsz, contents))
+        if (not s.p_flags & PF_X):
+            continue
+        for i, word in enumerate(contents[:len(contents) & ~3].cast("I")):
+            if (word == 0):
+                continue
+            try:
+                insns.append(cpu1.decode(s.p_paddr + 4 * i, word))
+            except Exception:
+                # data in the code
+                pass
+    symbols = {s.name: s.st_value for s in e.symbols if s.name and s.st_shndx != elf.SHN_UNDEF}
+    return Image(e.entry, segments, symbols, insns)
+
+
+def save(image, f):
+    handler = {name: i for i, name in enumerate(HANDLERS)}
+    names = [(value, name.encode()) for name, value in sorted(image.symbols.items())]
+    out = [HEADER.pack(MAGIC, VERSION, image.entry, len(image.segments), len(names), len(image.insns))]
+    offset = HEADER.size + SEGMENT.size * len(image.segments)
+    offset += sum(SYMBOL.size + len(name) for _, name in names)
+    offset += RECORD.size * len(image.insns)
+    for addr, memsz, data in image.segments:
+        out.append(SEGMENT.pack(addr, memsz, offset, len(data)))
+        offset += len(data)
+    for value, name in names:
+        out.append(SYMBOL.pack(value, len(name)) + name)
+    for d in image.insns:
+        out.append(RECORD.pack(d.pc, d.word, handler[d.name], d.rd, d.rs1, d.rs2, d.imm))
+    out += [bytes(data) for _, _, data in image.segments]
+    f.write(b"".join(out))
+
+
+def load(view):
+    # Image of an entry in a memoryview; segment data are views of it
+    magic, version, entry, nsegments, nsymbols, ninsns = HEADER.unpack_from(view, 0)
+    if (magic != MAGIC or version != VERSION):
+        raise Exception("not an image cache entry")
+    off = HEADER.size
+    segments = []
+    for _ in range(nsegments):
+        addr, memsz, start, filesz = SEGMENT.unpack_from(view, off)
+        segments.append((addr, memsz, view[start:start + filesz]))
+        off += SEGMENT.size
+    symbols = {}
+    for _ in range(nsymbols):
+        value, n = SYMBOL.unpack_from(view, off)
+        off += SYMBOL.size
+        symbols[bytes(view[off:off + n]).decode()] = value
+        off += n
+    insns = []
+    handlers = cpu1.HANDLERS
+    for pc, word, handler, rd, rs1, rs2, imm in RECORD.iter_unpack(view[off:off + RECORD.size * ninsns]):
+        name = HANDLERS[handler]
+        insns.append(cpu1.Insn(pc, word, name, handlers[name], rd, rs1, rs2, imm))
+    return Image(entry, segments, symbols, insns)
+
+
+def lookup(f):
+    # Image for an open ELF file, from the cache or built and added to it
+    data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    key = hashlib.sha256(KEY)
+    key.update(data)
+    path = os.path.join(directory(), key.hexdigest() + ".img")
+    try:
+        with open(path, "rb") as cached:
+            return load(memoryview(mmap.mmap(cached.fileno(), 0, access=mmap.ACCESS_READ)))
+    except Exception:
+        # missing, unreadable or damaged: make it again
+        pass
+    image = build(data)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as out:
+            save(image, out)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+    return image
+
+
+def load_elf(m, f):
+    # Machine.load_elf() through the cache
+    image = lookup(f)
+    for addr, memsz, data in image.segments:
+        m.memory.map(addr, data, memsz)
+        m.invalidate(addr, memsz)
+    for d in image.insns:
+        m.decode_cache[d.pc] = d
+    m.regs[cpu1.PC] = image.entry
+    m.mark()
+    return image
+
+
+def main():
+    for path in sys.argv[1:]:
+        with open(path, "rb") as f:
+            image = lookup(f)
+        print("%s: entry %08x, %d segments, %d symbols, %d instructions" % (
+            path, image.entry, len(image.segments), len(image.symbols), len(image.insns)))
+    print(directory())
+
+
+if __name__ == '__main__':
+    main()
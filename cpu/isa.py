@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+
+# RV32I instruction spec shared by the emulators, and the flat dispatch
+# table generated from it.
+#
+# "funct7" is given where it tells instructions apart (R-type and the
+# shift-immediates), "funct12" for the SYSTEM instructions without operands.
+
+INSTR = {"lui":   {"opcode": 0b0110111, "type": "U", "funct3": 0x0},
+         "auipc": {"opcode": 0b0010111, "type": "U", "funct3": 0x0},
+         "jal":   {"opcode": 0b1101111, "type": "J", "funct3": 0x0},
+
+         "jalr":  {"opcode": 0b1100111, "type": "I", "funct3": 0x0},
+
+         "beq":   {"opcode": 0b1100011, "type": "B", "funct3": 0x0},
+         "bne":   {"opcode": 0b1100011, "type": "B", "funct3": 0x1},
+         "blt":   {"opcode": 0b1100011, "type": "B", "funct3": 0x4},
+         "bge":   {"opcode": 0b1100011, "type": "B", "funct3": 0x5},
+         "bltu":  {"opcode": 0b1100011, "type": "B", "funct3": 0x6},
+         "bgeu":  {"opcode": 0b1100011, "type": "B", "funct3": 0x7},
+
+         "lb":    {"opcode": 0b0000011, "type": "I", "funct3": 0x0},
+         "lh":    {"opcode": 0b0000011, "type": "I", "funct3": 0x1},
+         "lw":    {"opcode": 0b0000011, "type": "I", "funct3": 0x2},
+         "lbu":   {"opcode": 0b0000011, "type": "I", "funct3": 0x4},
+
+         "lhu":   {"opcode": 0b0000011, "type": "I", "funct3": 0x5},
+         "sb":    {"opcode": 0b0100011, "type": "S", "funct3": 0x0},
+         "sh":    {"opcode": 0b0100011, "type": "S", "funct3": 0x1},
+
+         "sw":    {"opcode": 0b0100011, "type": "S", "funct3": 0x2},
+         "addi":  {"opcode": 0b0010011, "type": "I", "funct3": 0x0},
+         "slti":  {"opcode": 0b0010011, "type": "I", "funct3": 0x2},
+         "sltiu": {"opcode": 0b0010011, "type": "I", "funct3": 0x3},
+         "xori":  {"opcode": 0b0010011, "type": "I", "funct3": 0x4},
+         "ori":   {"opcode": 0b0010011, "type": "I", "funct3": 0x6},
+         "andi":  {"opcode": 0b0010011, "type": "I", "funct3": 0x7},
+         "slli":  {"opcode": 0b0010011, "type": "I", "funct3": 0x1, "funct7": 0b0000000},
+         "srli":  {"opcode": 0b0010011, "type": "I", "funct3": 0x5, "funct7": 0b0000000},
+         "srai":  {"opcode": 0b0010011, "type": "I", "funct3": 0x5, "funct7": 0b0100000},
+
+         "add":   {"opcode": 0b0110011, "type": "R", "funct3": 0x0, "funct7": 0b0000000},
+         "sub":   {"opcode": 0b0110011, "type": "R", "funct3": 0x0, "funct7": 0b0100000},
+         "sll":   {"opcode": 0b0110011, "type": "R", "funct3": 0x1, "funct7": 0b0000000},
+         "slt":   {"opcode": 0b0110011, "type": "R", "funct3": 0x2, "funct7": 0b0000000},
+         "sltu":  {"opcode": 0b0110011, "type": "R", "funct3": 0x3, "funct7": 0b0000000},
+         "xor":   {"opcode": 0b0110011, "type": "R", "funct3": 0x4, "funct7": 0b0000000},
+         "srl":   {"opcode": 0b0110011, "type": "R", "funct3": 0x5, "funct7": 0b0000000},
+         "sra":   {"opcode": 0b0110011, "type": "R", "funct3": 0x5, "funct7": 0b0100000},
+         "or":    {"opcode": 0b0110011, "type": "R", "funct3": 0x6, "funct7": 0b0000000},
+         "and":   {"opcode": 0b0110011, "type": "R", "funct3": 0x7, "funct7": 0b0000000},
+
+         # SYSTEM
+         "ecall":  {"opcode": 0b1110011, "type": "I", "funct3": 0x0, "funct12": 0x000},
+         "ebreak": {"opcode": 0b1110011, "type": "I", "funct3": 0x0, "funct12": 0x001},
+         "mret":   {"opcode": 0b1110011, "type": "I", "funct3": 0x0, "funct12": 0x302},
+         "csrrw": {"opcode": 0b1110011, "type": "I", "funct3": 0x1},
+         "csrrs": {"opcode": 0b1110011, "type": "I", "funct3": 0x2},
+         "csrrc": {"opcode": 0b1110011, "type": "I", "funct3": 0x3},
+         "csrrwi": {"opcode": 0b1110011, "type": "I", "funct3": 0x5},
+         "csrrsi": {"opcode": 0b1110011, "type": "I", "funct3": 0x6},
+         "csrrci": {"opcode": 0b1110011, "type": "I", "funct3": 0x7},
+
+         # MISC-MEM
+         "fence": {"opcode": 0b0001111, "type": "I", "funct3": 0x0},
+         "fence.i": {"opcode": 0b0001111, "type": "I", "funct3": 0x1},
+         }
+
+SYSTEM = 0b1110011
+
+LOADS = {"lb", "lh", "lw", "lbu", "lhu"}
+STORES = {"sb", "sh", "sw"}
+
+# major opcodes, named as in the spec's opcode map
+OPCODES = {0b0110111: "LUI", 0b0010111: "AUIPC", 0b1101111: "JAL", 0b1100111: "JALR",
+           0b1100011: "BRANCH", 0b0000011: "LOAD", 0b0100011: "STORE", 0b0010011: "OP-IMM",
+           0b0110011: "OP", 0b0001111: "MISC-MEM", 0b1110011: "SYSTEM"}
+
+# CSR number -> name, for the counters the emulators implement
+CSRS = {0xC00: "cycle", 0xC01: "time", 0xC02: "instret",
+        0xC80: "cycleh", 0xC81: "timeh", 0xC82: "instreth",
+        0xB00: "mcycle", 0xB02: "minstret", 0xB80: "mcycleh", 0xB82: "minstreth"}
+
+regnames = ["x0", "ra", "sp", "gp", "tp"] + ["t%d" % i for i in range(0, 3)] + ["s0", "s1"] + [
+    "a%d" % i for i in range(0, 8)] + ["s%d" % i for i in range(2, 12)] + ["t%d" % i for i in range(3, 7)] + ["PC"]
+
+
+# *** Immediates ***
+# Sign-extended, per instruction format.
+
+def imm_i(inst):
+    return ((inst >> 20) ^ 0x800) - 0x800
+
+
+def imm_s(inst):
+    imm = (inst >> 25) << 5 | (inst >> 7) & 0x1f
+    return (imm ^ 0x800) - 0x800
+
+
+def imm_b(inst):
+    imm = (inst >> 31) << 12 | ((inst >> 7) & 0x1) << 11 | ((inst >> 25) & 0x3f) << 5 | ((inst >> 8) & 0xf) << 1
+    return (imm ^ 0x1000) - 0x1000
+
+
+def imm_u(inst):
+    return inst & 0xFFFFF000
+
+
+def imm_j(inst):
+    imm = (inst >> 31) << 20 | ((inst >> 12) & 0xff) << 12 | ((inst >> 20) & 0x1) << 11 | ((inst >> 21) & 0x3ff) << 1
+    return (imm ^ 0x100000) - 0x100000
+
+
+def imm_shamt(inst):
+    return (inst >> 20) & 0x1f
+
+
+def imm_csr(inst):
+    # csr number / funct12, unsigned
+    return inst >> 20
+
+
+def imm_none(inst):
+    return 0
+
+
+def immediate(name):
+    # immediate decoder for a mnemonic
+    spec = INSTR[name]
+    if (spec["type"] == "I" and "funct7" in spec):
+        return imm_shamt
+    if (spec["type"] == "I" and spec["opcode"] == SYSTEM):
+        return imm_csr
+    return {"U": imm_u, "J": imm_j, "B": imm_b, "S": imm_s, "I": imm_i, "R": imm_none}[spec["type"]]
+
+
+def operands(name):
+    # which of rd, rs1, rs2 a mnemonic has
+    t = INSTR[name]["type"]
+    return (t in ("R", "I", "U", "J"), t in ("R", "I", "S", "B"), t in ("R", "S", "B"))
+
+
+def fits(name, what, value, lo, hi, align=1):
+    # raise unless lo <= value <= hi and value is a multiple of align
+    if (not lo <= value <= hi):
+        raise Exception("%s: %s %d out of range [%d, %d]" % (name, what, value, lo, hi))
+    if (value % align):
+        raise Exception("%s: %s %d is not a multiple of %d" % (name, what, value, align))
+
+
+def encode(name, rd=0, rs1=0, rs2=0, imm=0):
+    # instruction word for a mnemonic; imm is the (signed) immediate, the
+    # byte offset for branches and jumps, the csr number for csr*, and the
+    # shift amount for the shift-immediates. Fields that don't fit raise.
+    spec = INSTR[name]
+    t = spec["type"]
+    inst = spec["opcode"] | spec["funct3"] << 12
+    if ("funct12" in spec):
+        return inst | spec["funct12"] << 20
+    for what, r in (("rd", rd), ("rs1", rs1), ("rs2", rs2)):
+        fits(name, what, r, 0, 31)
+    if (t == "R"):
+        return inst | rd << 7 | rs1 << 15 | rs2 << 20 | spec["funct7"] << 25
+    if (t == "I"):
+        if ("funct7" in spec):
+            fits(name, "shift amount", imm, 0, 31)
+            imm |= spec["funct7"] << 5
+        elif (spec["opcode"] == SYSTEM):
+            fits(name, "csr", imm, 0, 0xfff)
+        else:
+            fits(name, "immediate", imm, -0x800, 0x7ff)
+        return inst | rd << 7 | rs1 << 15 | (imm & 0xfff) << 20
+    if (t == "S"):
+        fits(name, "immediate", imm, -0x800, 0x7ff)
+        imm &= 0xfff
+        return inst | (imm & 0x1f) << 7 | rs1 << 15 | rs2 << 20 | (imm >> 5) << 25
+    if (t == "B"):
+        fits(name, "offset", imm, -0x1000, 0xffe, 2)
+        imm &= 0x1fff
+        return (inst | ((imm >> 11) & 0x1) << 7 | ((imm >> 1) & 0xf) << 8 | rs1 << 15 | rs2 << 20 |
+                ((imm >> 5) & 0x3f) << 25 | (imm >> 12) << 31)
+    if (t == "U"):
+        # the value with its low 12 bits clear, signed or not
+        fits(name, "immediate", imm, -0x80000000, 0xFFFFF000, 0x1000)
+        return spec["opcode"] | rd << 7 | (imm & 0xFFFFF000)
+    if (t == "J"):
+        fits(name, "offset", imm, -0x100000, 0xffffe, 2)
+        imm &= 0x1fffff
+        return (spec["opcode"] | rd << 7 | ((imm >> 12) & 0xff) << 12 | ((imm >> 11) & 0x1) << 20 |
+                ((imm >> 1) & 0x3ff) << 21 | (imm >> 20) << 31)
+    raise Exception("can't encode %s" % name)
+
+
+# *** Dispatch table ***
+# One flat list indexed directly by opcode | funct3 << 7 | funct7 << 10.
+# Fields an instruction doesn't have (funct3 of U/J, funct7 of I/S/B) are
+# immediate bits, so its entry is repeated over all their values. Entries
+# that still collide (ecall/ebreak) become a dict keyed by funct12.
+
+def index(inst):
+    return inst & 0x7f | (inst >> 5) & 0x380 | (inst >> 15) & 0x1fc00
+
+
+def table(values):
+    # values: mnemonic -> table entry; mnemonics not in it stay None
+    t = [None] * (1 << 17)
+    for name, spec in INSTR.items():
+        if (name not in values):
+            continue
+        funct3s = range(8) if spec["type"] in ("U", "J") else [spec["funct3"]]
+        if ("funct12" in spec):
+            funct7s = [spec["funct12"] >> 5]
+        elif ("funct7" in spec):
+            funct7s = [spec["funct7"]]
+        else:
+            funct7s = range(128)
+        for funct3 in funct3s:
+            for funct7 in funct7s:
+                i = spec["opcode"] | funct3 << 7 | funct7 << 10
+                if ("funct12" in spec):
+                    if (t[i] is None):
+                        t[i] = {}
+                    t[i][spec["funct12"]] = values[name]
+                else:
+                    assert t[i] is None, name
+                    t[i] = values[name]
+    return t
+
+
+def lookup(t, inst):
+    e = t[index(inst)]
+    if (type(e) is dict):
+        return e.get(inst >> 20)
+    return e
@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+
+# Basic-block translator.
+#
+# Straight-line RV32I code up to (and including) the next BRANCH/JAL/JALR/
+# fence.i instruction is translated once into the source of a Python
+# function, with register indices and immediates folded in as constants, and
+# compiled with compile()/exec(). A block takes the machine and its raw
+# register list, sets the PC, and returns the next Block when it is linked
+# to it, None otherwise. Instructions without a template fall back to
+# calling their interpreter handler from the block. SYSTEM instructions
+# always get a block of their own, so a dispatcher can look at them before
+# they run.
+#
+# Chaining: every exit with a static target (fall-through, jal, both arms
+# of a branch) returns a slot of the block's links list. Slots start out
+# None, so the dispatcher looks the target up and BlockCache.link() fills
+# the slot; after that the exit hands back its successor directly. Blocks
+# keep who links to them, so dropping a block unlinks it everywhere. No
+# block is ever linked to a SYSTEM block.
+
+MASK = 0xFFFFFFFF
+MAX_BLOCK = 64
+
+# name -> statement template. {rd} etc. come from the decoded Insn, {uimm}
+# is the immediate as an unsigned 32-bit constant, {next} is pc + 4.
+ALU = {
+    "lui":   "r[{rd}] = {uimm}",
+    "auipc": "r[{rd}] = {uimm}",
+    "addi":  "r[{rd}] = (r[{rs1}] + {imm}) & 0xFFFFFFFF",
+    "slti":  "r[{rd}] = int((r[{rs1}] ^ 0x80000000) - 0x80000000 < {imm})",
+    "sltiu": "r[{rd}] = int(r[{rs1}] < {uimm})",
+    "andi":  "r[{rd}] = r[{rs1}] & {uimm}",
+    "ori":   "r[{rd}] = r[{rs1}] | {uimm}",
+    "xori":  "r[{rd}] = r[{rs1}] ^ {uimm}",
+    "slli":  "r[{rd}] = (r[{rs1}] << {imm}) & 0xFFFFFFFF",
+    "srli":  "r[{rd}] = r[{rs1}] >> {imm}",
+    "srai":  "r[{rd}] = (((r[{rs1}] ^ 0x80000000) - 0x80000000) >> {imm}) & 0xFFFFFFFF",
+    "add":   "r[{rd}] = (r[{rs1}] + r[{rs2}]) & 0xFFFFFFFF",
+    "sub":   "r[{rd}] = (r[{rs1}] - r[{rs2}]) & 0xFFFFFFFF",
+    "slt":   "r[{rd}] = int((r[{rs1}] ^ 0x80000000) < (r[{rs2}] ^ 0x80000000))",
+    "sltu":  "r[{rd}] = int(r[{rs1}] < r[{rs2}])",
+    "and":   "r[{rd}] = r[{rs1}] & r[{rs2}]",
+    "or":    "r[{rd}] = r[{rs1}] | r[{rs2}]",
+    "xor":   "r[{rd}] = r[{rs1}] ^ r[{rs2}]",
+    "sll":   "r[{rd}] = (r[{rs1}] << (r[{rs2}] & 0x1f)) & 0xFFFFFFFF",
+    "srl":   "r[{rd}] = r[{rs1}] >> (r[{rs2}] & 0x1f)",
+    "sra":   "r[{rd}] = (((r[{rs1}] ^ 0x80000000) - 0x80000000) >> (r[{rs2}] & 0x1f)) & 0xFFFFFFFF",
+}
+
+# conditions for the taken arm of a branch
+BRANCH = {
+    "beq":  "r[{rs1}] == r[{rs2}]",
+    "bne":  "r[{rs1}] != r[{rs2}]",
+    "blt":  "(r[{rs1}] ^ 0x80000000) < (r[{rs2}] ^ 0x80000000)",
+    "bge":  "(r[{rs1}] ^ 0x80000000) >= (r[{rs2}] ^ 0x80000000)",
+    "bltu": "r[{rs1}] < r[{rs2}]",
+    "bgeu": "r[{rs1}] >= r[{rs2}]",
+}
+
+# SYSTEM instructions, each translated as a one-instruction block
+SYSTEM = {"ecall", "ebreak", "mret",
+          "csrrw", "csrrs", "csrrc", "csrrwi", "csrrsi", "csrrci"}
+
+# names that end a block; fence.i makes earlier stores to code visible, so
+# it ends a block too
+ENDS = set(BRANCH) | SYSTEM | {"jal", "jalr", "fence.i"}
+
+
+class Block:
+    __slots__ = ("pc", "n", "fn", "src", "exits", "links", "preds", "chainable")
+
+    def __init__(self, pc, n, fn, src, exits, links, chainable):
+        self.pc = pc
+        self.n = n
+        self.fn = fn
+        self.src = src
+        # static target pc -> slot in links
+        self.exits = exits
+        # slot -> linked successor Block or None
+        self.links = links
+        # (block, slot) pairs linked to this block
+        self.preds = []
+        # whether other blocks may link to this one
+        self.chainable = chainable
+
+
+def fields(d):
+    return {"rd": d.rd, "rs1": d.rs1, "rs2": d.rs2, "imm": d.imm,
+            "uimm": d.imm & MASK, "next": (d.pc + 4) & MASK}
+
+
+def goto(pc, exits):
+    # statements for a static exit to pc
+    slot = exits.setdefault(pc, len(exits))
+    return ["r[32] = %d" % pc, "return L[%d]" % slot]
+
+
+def emit(d, i, ns, exits):
+    # statements for one instruction; i numbers the fallback records in ns
+    f = fields(d)
+    if (d.name in ALU):
+        if (d.rd == 0):
+            return []
+        return [ALU[d.name].format(**f)]
+    if (d.name in BRANCH):
+        return (["if " + BRANCH[d.name].format(**f) + ":"] +
+                ["    " + x for x in goto(d.imm, exits)] +
+                goto(f["next"], exits))
+    if (d.name == "jal"):
+        out = [] if d.rd == 0 else ["r[%d] = %d" % (d.rd, f["next"])]
+        return out + goto(d.imm, exits)
+    if (d.name == "jalr"):
+        out = ["t = (r[{rs1}] + {imm}) & 0xFFFFFFFE".format(**f)]
+        if (d.rd != 0):
+            out.append("r[%d] = %d" % (d.rd, f["next"]))
+        return out + ["r[32] = t", "return None"]
+    # no template: call the interpreter handler, which also updates the PC
+    ns["h%d" % i] = d.fn
+    ns["d%d" % i] = d
+    out = ["h%d(m, d%d)" % (i, i), "r[0] = 0"]
+    if (d.name in ENDS):
+        out.append("return None")
+    return out
+
+
+def translate(pc, decode_at):
+    # decode_at(pc) returns the Insn at pc, or None where execution stops,
+    # and raises for an illegal word
+    insns = []
+    addr = pc
+    while len(insns) < MAX_BLOCK:
+        try:
+            d = decode_at(addr)
+        except Exception:
+            # an illegal word ends the block in front of it; it raises
+            # when it is reached, as the first word of a block
+            if (not insns):
+                raise
+            break
+        if (d is None or (insns and d.name in SYSTEM)):
+            break
+        insns.append(d)
+        if (d.name in ENDS):
+            break
+        addr = (addr + 4) & MASK
+    if (not insns):
+        return None
+
+    ns = {}
+    exits = {}
+    body = []
+    for i, d in enumerate(insns):
+        body += emit(d, i, ns, exits)
+    if (insns[-1].name not in ENDS):
+        body += goto((insns[-1].pc + 4) & MASK, exits)
+    links = ns["L"] = [None] * len(exits)
+    src = "def block(m, r):\n" + "".join("    %s\n" % line for line in body)
+    exec(compile(src, "<block 0x%08x>" % pc, "exec"), ns)
+    return Block(pc, len(insns), ns["block"], src, exits, links, insns[0].name not in SYSTEM)
+
+
+class BlockCache:
+    def __init__(self, decode_at):
+        self.decode_at = decode_at
+        self.blocks = {}
+        # instruction pc -> start pcs of the blocks that contain it
+        self.owners = {}
+
+    def get(self, pc):
+        b = self.blocks.get(pc)
+        if (b is None):
+            b = translate(pc, self.decode_at)
+            if (b is None):
+                return None
+            self.blocks[pc] = b
+            for i in range(b.n):
+                self.owners.setdefault((pc + 4 * i) & MASK, []).append(pc)
+        return b
+
+    def link(self, b, pc):
+        # the block at pc, where b just exited to through an empty slot or
+        # a dynamic exit; a static exit gets linked for next time
+        nb = self.get(pc)
+        if (nb is not None and nb.chainable):
+            slot = b.exits.get(pc)
+            if (slot is not None and b.links[slot] is None and self.blocks.get(b.pc) is b):
+                b.links[slot] = nb
+                nb.preds.append((b, slot))
+        return nb
+
+    def drop(self, b):
+        # forget b's instructions and unlink it from its predecessors and
+        # successors
+        for i in range(b.n):
+            pc = (b.pc + 4 * i) & MASK
+            starts = self.owners.get(pc)
+            if (starts is not None and b.pc in starts):
+                starts.remove(b.pc)
+                if (not starts):
+                    del self.owners[pc]
+        for pred, slot in b.preds:
+            if (pred.links[slot] is b):
+                pred.links[slot] = None
+        b.preds = []
+        for slot, succ in enumerate(b.links):
+            if (succ is not None):
+                succ.preds.remove((b, slot))
+                b.links[slot] = None
+
+    def invalidate(self, addr, length):
+        # drop every block holding a word that overlaps [addr, addr + length)
+        if (length > len(self.owners)):
+            stale = [pc for pc in self.owners if addr - 4 < pc < addr + length]
+        else:
+            stale = range(addr - 3, addr + length)
+        for pc in stale:
+            for start in self.owners.pop(pc, ()):
+                b = self.blocks.pop(start, None)
+                if (b is not None):
+                    self.drop(b)
+
+    def clear(self):
+        self.blocks.clear()
+        self.owners.clear()
@@ -0,0 +1,21 @@
+#!/usr/bin/python3
+
+# ELF loader. The file is mmap'd read-only (elf.read()) and each PT_LOAD
+# segment is mapped into guest memory as a view of it (Memory.map()), so
+# loading copies nothing: pages are faulted in when the guest first touches
+# them, .bss included, and the first store to a page copies it
+# (copy-on-write), so the file is never written.
+
+import elf
+
+
+def load_elf(memory, f):
+    # returns (entry point, [(addr, size) of each mapped segment])
+    e = elf.read(f)
+    segments = []
+    for s in e.segments:
+        if (s.p_type != elf.PT_LOAD or s.p_memsz == 0):
+            continue
+        memory.map(s.p_paddr, e.contents(s), s.p_memsz)
+        segments.append((s.p_paddr, s.p_memsz))
+    return e.entry, segments
@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+
+# Differential execution: runs the same ELF on two engines side by side and
+# reports the first instruction where their architectural state differs.
+#
+# Both engines run N instructions at a time at full speed, then a digest of
+# their registers and memory is compared and folded into a rolling hash.
+# Only when a digest differs (or one engine stops or raises) are both
+# engines rebuilt, fast-forwarded to the last checkpoint that matched, and
+# stepped one instruction at a time to pinpoint the divergence.
+#
+#   ./lockstep.py [--ref cpu1] [--engine cpu] [--every N] [--limit N] [elf ...]
+#
+# Engines stop in front of ecall, where riscv-tests report their result.
+# A program is the path of an ELF, or (entry, image) for raw code loaded at
+# its entry point (see fuzz.py).
+
+import argparse
+import glob
+import os
+import struct
+import sys
+import zlib
+
+import cpu1
+import loader
+from disasm import disasm, mnemonic
+from isa import regnames
+from memory import PAGE_SHIFT, PAGE_SIZE
+from runtests import TESTS
+
+PC = 32
+REGS = struct.Struct("<33I")
+PN = struct.Struct("<I")
+
+
+class ModuleEngine:
+    # an interpreter module with cpu.py's interface: init(), process(),
+    # and the globals regfile and memory. Modules hold one machine each,
+    # so creating an engine resets any earlier one of the same module.
+
+    def __init__(self, module, program):
+        self.module = module
+        module.init()
+        if (isinstance(program, str)):
+            with open(program, "rb") as f:
+                entry, _ = loader.load_elf(module.memory, f)
+        else:
+            entry, image = program
+            module.load(entry, image)
+        module.regfile[PC] = entry
+        self.memory = module.memory
+        self.regs = module.regfile.regs
+
+    def run(self, n):
+        # up to n instructions; returns how many ran
+        module = self.module
+        for i in range(n):
+            if (mnemonic(module.fetch(self.regs[PC])) == "ecall" or not module.process()):
+                return i
+        return n
+
+
+class MachineEngine:
+    def __init__(self, program):
+        self.m = cpu1.Machine()
+        if (isinstance(program, str)):
+            with open(program, "rb") as f:
+                self.m.load_elf(f)
+        else:
+            entry, image = program
+            self.m.load(entry, image)
+            self.m.regs[PC] = entry
+        self.memory = self.m.memory
+        self.regs = self.m.regs
+
+    def run(self, n):
+        m = self.m
+        r = self.regs
+        for i in range(n):
+            d = m.decode_at(r[PC])
+            if (d is None or d.name == "ecall"):
+                return i
+            d.fn(m, d)
+            r[0] = 0
+        return n
+
+
+def engine_cpu(program):
+    import cpu
+    return ModuleEngine(cpu, program)
+
+
+def engine_cpu1_process(program):
+    return ModuleEngine(cpu1, program)
+
+
+ENGINES = {"cpu": engine_cpu, "cpu1": MachineEngine, "cpu1-process": engine_cpu1_process}
+
+
+def pages(a, b):
+    # page numbers either engine has touched
+    return sorted(set(a.memory.pages) | set(b.memory.pages))
+
+
+def digest(e, pns):
+    crc = zlib.crc32(REGS.pack(*e.regs))
+    for pn in pns:
+        crc = zlib.crc32(PN.pack(pn), crc)
+        crc = zlib.crc32(e.memory.read(pn << PAGE_SHIFT, PAGE_SIZE), crc)
+    return crc
+
+
+def run(e, n):
+    # (instructions run, exception or None)
+    try:
+        return e.run(n), None
+    except Exception as ex:
+        return None, ex
+
+
+def describe(a, b, count, pc, why):
+    # the divergence at instruction number count, at pc, as text
+    word = b.memory.read32(pc)
+    lines = ["diverged at instruction %d, pc %08x: %s (%s)" % (count, pc, disasm(word, pc), why)]
+    for i in range(33):
+        if (a.regs[i] != b.regs[i]):
+            lines.append("  %3s  ref %08x  engine %08x" % (regnames[i], a.regs[i], b.regs[i]))
+    for pn in pages(a, b):
+        x = a.memory.read(pn << PAGE_SHIFT, PAGE_SIZE)
+        y = b.memory.read(pn << PAGE_SHIFT, PAGE_SIZE)
+        if (x != y):
+            off = next(i for i in range(PAGE_SIZE) if x[i] != y[i])
+            lines.append("  mem  [%08x]  ref %02x  engine %02x" % ((pn << PAGE_SHIFT) + off, x[off], y[off]))
+    return "\n".join(lines)
+
+
+def same_fault(a, b, ea, eb):
+    # whether both engines raised the same exception at the same pc
+    return (ea is not None and eb is not None and type(ea) is type(eb) and str(ea) == str(eb) and
+            a.regs[PC] == b.regs[PC])
+
+
+def pinpoint(ref, engine, program, start, end):
+    # replay from scratch, fast-forward to start (which matched), then step
+    # up to end; returns (instructions, divergence text or None). Both
+    # engines raising the same exception at the same instruction is where
+    # they end, in agreement.
+    a = ref(program)
+    b = engine(program)
+    a.run(start)
+    b.run(start)
+    for count in range(start, end + 1):
+        pc = a.regs[PC]
+        na, ea = run(a, 1)
+        nb, eb = run(b, 1)
+        if (same_fault(a, b, ea, eb)):
+            return count, None
+        if (ea is not None or eb is not None):
+            why = ", ".join("%s raised %s: %s" % (who, type(e).__name__, e)
+                            for who, e in (("ref", ea), ("engine", eb)) if e is not None)
+            return count, describe(a, b, count, pc, why)
+        if (na != nb):
+            return count, describe(a, b, count, pc, "ref %s, engine %s" % (
+                "stopped" if na == 0 else "ran", "stopped" if nb == 0 else "ran"))
+        if (na == 0):
+            return count, None
+        pns = pages(a, b)
+        if (a.regs != b.regs or digest(a, pns) != digest(b, pns)):
+            return count, describe(a, b, count, pc, "state differs after it")
+    return end, describe(a, b, end, a.regs[PC], "state differs")
+
+
+def compare(ref, engine, program, every=1000, limit=1000000):
+    # returns (instructions, rolling hash, divergence text or None)
+    a = ref(program)
+    b = engine(program)
+    count = 0
+    rolling = 0
+    while count < limit:
+        na, ea = run(a, every)
+        nb, eb = run(b, every)
+        if (ea is None and eb is None and na == nb):
+            pns = pages(a, b)
+            da = digest(a, pns)
+            if (da == digest(b, pns)):
+                rolling = zlib.crc32(PN.pack(da), rolling)
+                count += na
+                if (na < every):
+                    return count, rolling, None
+                continue
+        # somewhere in this chunk; an engine that raised doesn't say where
+        count, divergence = pinpoint(ref, engine, program, count, count + every)
+        return count, rolling, divergence
+    return count, rolling, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="run two engines in lockstep")
+    parser.add_argument("elf", nargs="*", help="test ELFs (default: rv32ui/rv32um suite)")
+    parser.add_argument("--ref", default="cpu1", choices=ENGINES, help="reference engine")
+    parser.add_argument("--engine", default="cpu", choices=ENGINES, help="engine under test")
+    parser.add_argument("--every", type=int, default=1000, help="instructions between state checks")
+    parser.add_argument("--limit", type=int, default=1000000, help="instructions per test")
+    args = parser.parse_args()
+
+    paths = args.elf or [x for pattern in TESTS for x in glob.glob(pattern)]
+    paths = sorted(x for x in paths if not x.endswith(('.dump', '.trace')))
+    agreed = 0
+    for path in paths:
+        count, rolling, divergence = compare(ENGINES[args.ref], ENGINES[args.engine], path,
+                                             args.every, args.limit)
+        if (divergence is None):
+            agreed += 1
+            print("SAME    %-24s %10d instructions  hash %08x" % (os.path.basename(path), count, rolling))
+        else:
+            print("DIFFER  %-24s %s" % (os.path.basename(path), divergence))
+    print("%d/%d agree" % (agreed, len(paths)))
+    return 0 if agreed == len(paths) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
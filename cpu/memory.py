@@ -0,0 +1,288 @@
+#!/usr/bin/python3
+
+import bisect
+import sys
+
+# Guest memory: the full 4 GB RV32 address space, split into 4 KB pages
+# that are allocated on first write. Reads of untouched pages return zeros
+# without allocating anything. Each page is a mutable bytearray; aligned
+# half and word accesses go through memoryview casts of it, so every access
+# and every store is O(1). The casts use host byte order, which must match
+# RV32's.
+#
+# map() backs a range with an existing read-only buffer (an mmap'd ELF
+# segment) instead of copying it. Nothing is read until a page in the range
+# is first touched; then fault() makes the page, as a view of the buffer
+# when the buffer covers all of it and as a copy otherwise (partial pages,
+# .bss).
+#
+# Pages are copy-on-write. pages holds every page for reading; writable
+# holds the ones this memory may store into in place. A store to any other
+# page (a view of a mapping, or a page shared with a snapshot) copies it
+# first. snapshot() shares every page, so writable is also the set of pages
+# dirtied since the last snapshot and restore() to it is O(dirty pages).
+#
+# Memory is also the bus for memory-mapped devices. Their ranges are whole
+# pages that never get a Page, so RAM accesses never look for a device:
+# only accesses that miss in pages/writable check io_pages, and only those
+# that hit it find their device (by bisect) and call its read/write.
+# Devices only see aligned accesses; unaligned or page-crossing ones that
+# touch a device page raise.
+assert sys.byteorder == "little"
+
+PAGE_SHIFT = 12
+PAGE_SIZE = 1 << PAGE_SHIFT
+PAGE_MASK = PAGE_SIZE - 1
+
+
+class Page:
+    __slots__ = ("data", "u16", "u32")
+
+    def __init__(self, data=None):
+        self.data = bytearray(PAGE_SIZE) if data is None else data
+        view = memoryview(self.data)
+        self.u16 = view.cast("H")
+        self.u32 = view.cast("I")
+
+
+def fill(p, pn, region):
+    # copy the part of region that falls in page pn into p
+    start, size, data = region
+    lo = max(start, pn << PAGE_SHIFT)
+    hi = min(start + size, (pn + 1) << PAGE_SHIFT)
+    if (lo >= hi):
+        return
+    n = max(0, min(hi - start, len(data)) - (lo - start))
+    off = lo & PAGE_MASK
+    p.data[off:off + n] = data[lo - start:lo - start + n]
+    p.data[off + n:off + hi - lo] = bytes(hi - lo - n)
+
+
+def materialize(regions, pn):
+    # page pn as made from the mapped regions, or None if none covers it;
+    # the page is a read-only view when a single region's data covers it
+    lo = pn << PAGE_SHIFT
+    hits = [r for r in regions if r[0] < lo + PAGE_SIZE and lo < r[0] + r[1]]
+    if (not hits):
+        return None
+    start, size, data = hits[-1]
+    off = lo - start
+    if (len(hits) == 1 and off >= 0 and off + PAGE_SIZE <= len(data)):
+        return Page(data[off:off + PAGE_SIZE])
+    p = Page()
+    for region in hits:
+        fill(p, pn, region)
+    return p
+
+
+class Memory:
+    def __init__(self):
+        # page number -> Page
+        self.pages = {}
+        # the pages that may be written in place, see above
+        self.writable = {}
+        # mapped (start, size, data), in map() order; pages are made from
+        # them on first access
+        self.regions = []
+        # pages of the last snapshot(), what writable is relative to
+        self.base = None
+        # devices as (start, end, device) sorted by start, their starts, and
+        # the page numbers they cover
+        self.devices = []
+        self.device_starts = []
+        self.io_pages = set()
+        # pages faulted in since then
+        self.faulted = []
+
+    def page(self, pn):
+        # page for writing: copied if it is shared, allocated if missing
+        if (pn in self.io_pages):
+            raise Exception("unsupported device access at 0x%08x" % (pn << PAGE_SHIFT))
+        p = self.pages.get(pn) or self.fault(pn)
+        p = Page() if p is None else Page(bytearray(p.data))
+        self.pages[pn] = self.writable[pn] = p
+        return p
+
+    def map(self, addr, data, size):
+        # back [addr, addr + size) with data, zero-filled past its end. data
+        # is never written and must stay valid
+        region = (addr, size, memoryview(data))
+        self.regions.append(region)
+        for pn in range(addr >> PAGE_SHIFT, (addr + size + PAGE_MASK) >> PAGE_SHIFT):
+            if (pn in self.pages):
+                fill(self.writable.get(pn) or self.page(pn), pn, region)
+
+    def fault(self, pn):
+        # first access to page pn: make it from the mapped regions, or
+        # return None if none of them covers it
+        if (not self.regions or pn in self.io_pages):
+            return None
+        p = materialize(self.regions, pn)
+        if (p is not None):
+            self.pages[pn] = p
+            self.faulted.append(pn)
+        return p
+
+    def attach(self, start, size, device):
+        # route [start, start + size) to device.read(offset, size) and
+        # device.write(offset, size, value); the range must be whole pages
+        # that hold no memory yet
+        if (start & PAGE_MASK or size & PAGE_MASK or size == 0):
+            raise Exception("device range must be whole pages")
+        pns = range(start >> PAGE_SHIFT, (start + size) >> PAGE_SHIFT)
+        if (any(pn in self.io_pages or pn in self.pages for pn in pns)):
+            raise Exception("device range at 0x%08x is in use" % start)
+        i = bisect.bisect(self.device_starts, start)
+        self.devices.insert(i, (start, start + size, device))
+        self.device_starts.insert(i, start)
+        self.io_pages.update(pns)
+
+    def device(self, addr):
+        # (device, offset) for addr, or (None, 0)
+        i = bisect.bisect(self.device_starts, addr) - 1
+        if (i >= 0):
+            start, end, device = self.devices[i]
+            if (addr < end):
+                return device, addr - start
+        return None, 0
+
+    def io_read(self, addr, size):
+        # a load that missed the pages: a device register or unmapped zeros
+        if (addr >> PAGE_SHIFT not in self.io_pages):
+            return 0
+        device, offset = self.device(addr)
+        return device.read(offset, size)
+
+    def io_write(self, addr, size, value):
+        device, offset = self.device(addr)
+        device.write(offset, size, value)
+
+    def check_io(self, addr, length):
+        # read() and load() go byte by byte around the devices, so the
+        # unaligned and page-crossing accesses they do must not touch one
+        if (self.io_pages):
+            for pn in range(addr >> PAGE_SHIFT, ((addr + length - 1) >> PAGE_SHIFT) + 1):
+                if (pn & 0xFFFFF in self.io_pages):
+                    raise Exception("unsupported device access at 0x%08x" % addr)
+
+    def snapshot(self):
+        # (pages, regions) as of now; every page becomes shared
+        self.writable = {}
+        self.faulted = []
+        self.base = dict(self.pages)
+        return self.base, list(self.regions)
+
+    def restore(self, snapshot):
+        # back to a snapshot; returns the page numbers that changed, or None
+        # if that is potentially all of them
+        pages, regions = snapshot
+        if (pages is self.base):
+            changed = set(self.writable)
+            # pages faulted in since and never written are what the snapshot
+            # would fault in too, unless map() came in between: they stay,
+            # and join the snapshot
+            same = len(regions) == len(self.regions) and all(x is y for x, y in zip(regions, self.regions))
+            for pn in self.faulted:
+                if (pn in changed):
+                    continue
+                if (same):
+                    pages[pn] = self.pages[pn]
+                else:
+                    changed.add(pn)
+            for pn in changed:
+                p = pages.get(pn)
+                if (p is None):
+                    self.pages.pop(pn, None)
+                else:
+                    self.pages[pn] = p
+        else:
+            changed = None
+            self.pages = dict(pages)
+            self.base = pages
+        self.regions = list(regions)
+        self.writable = {}
+        self.faulted = []
+        return changed
+
+    def load(self, addr, data):
+        data = memoryview(data)
+        self.check_io(addr, len(data))
+        while data:
+            off = addr & PAGE_MASK
+            n = min(PAGE_SIZE - off, len(data))
+            self.page(addr >> PAGE_SHIFT).data[off:off + n] = data[:n]
+            addr = (addr + n) & 0xFFFFFFFF
+            data = data[n:]
+
+    def read(self, addr, length):
+        self.check_io(addr, length)
+        out = bytearray()
+        while length > 0:
+            off = addr & PAGE_MASK
+            n = min(PAGE_SIZE - off, length)
+            p = self.pages.get(addr >> PAGE_SHIFT) or self.fault(addr >> PAGE_SHIFT)
+            out += bytes(n) if p is None else p.data[off:off + n]
+            addr = (addr + n) & 0xFFFFFFFF
+            length -= n
+        return bytes(out)
+
+    def read8(self, addr):
+        p = self.pages.get(addr >> PAGE_SHIFT)
+        if (p is None):
+            p = self.fault(addr >> PAGE_SHIFT)
+            if (p is None):
+                return self.io_read(addr, 1)
+        return p.data[addr & PAGE_MASK]
+
+    def read16(self, addr):
+        if (addr & 1 == 0):
+            p = self.pages.get(addr >> PAGE_SHIFT)
+            if (p is None):
+                p = self.fault(addr >> PAGE_SHIFT)
+                if (p is None):
+                    return self.io_read(addr, 2)
+            return p.u16[(addr & PAGE_MASK) >> 1]
+        return int.from_bytes(self.read(addr, 2), "little")
+
+    def read32(self, addr):
+        if (addr & 3 == 0):
+            p = self.pages.get(addr >> PAGE_SHIFT)
+            if (p is None):
+                p = self.fault(addr >> PAGE_SHIFT)
+                if (p is None):
+                    return self.io_read(addr, 4)
+            return p.u32[(addr & PAGE_MASK) >> 2]
+        return int.from_bytes(self.read(addr, 4), "little")
+
+    def write8(self, addr, value):
+        pn = addr >> PAGE_SHIFT
+        p = self.writable.get(pn)
+        if (p is None):
+            if (pn in self.io_pages):
+                return self.io_write(addr, 1, value & 0xFF)
+            p = self.page(pn)
+        p.data[addr & PAGE_MASK] = value & 0xFF
+
+    def write16(self, addr, value):
+        if (addr & 1 == 0):
+            pn = addr >> PAGE_SHIFT
+            p = self.writable.get(pn)
+            if (p is None):
+                if (pn in self.io_pages):
+                    return self.io_write(addr, 2, value & 0xFFFF)
+                p = self.page(pn)
+            p.u16[(addr & PAGE_MASK) >> 1] = value & 0xFFFF
+            return
+        self.load(addr, (value & 0xFFFF).to_bytes(2, "little"))
+
+    def write32(self, addr, value):
+        if (addr & 3 == 0):
+            pn = addr >> PAGE_SHIFT
+            p = self.writable.get(pn)
+            if (p is None):
+                if (pn in self.io_pages):
+                    return self.io_write(addr, 4, value & 0xFFFFFFFF)
+                p = self.page(pn)
+            p.u32[(addr & PAGE_MASK) >> 2] = value & 0xFFFFFFFF
+            return
+        self.load(addr, (value & 0xFFFFFFFF).to_bytes(4, "little"))
@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+
+# Parallel riscv-tests runner: fans the rv32ui/rv32um ELF suite out over a
+# process pool (one worker per core), runs each test in cpu1 with an
+# instruction limit and a timeout, and writes a JSON and/or JUnit summary.
+#
+#   ./runtests.py [--jit] [--cache] [--limit N] [--timeout S] [--json out.json] [--junit out.xml] [elf ...]
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import xml.etree.ElementTree as ET
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+import cpu1
+import imagecache
+
+TESTS = ["/home/adam/dev/riscv-tests/isa/rv32ui-p-*",
+         "/home/adam/dev/riscv-tests/isa/rv32um-p-*"]
+
+# check the wall clock every this many instructions
+TIME_CHECK = 10000
+
+
+# Both loops stop in front of the first ecall and return
+# (status, gp, instructions). riscv-tests report through gp (x3): 1 is a
+# pass, (testnum << 1) | 1 is a failure of test testnum.
+
+def run_insns(m, limit, deadline):
+    r = m.regs
+    decode_cache = m.decode_cache
+    instrcnt = 0
+    while instrcnt < limit:
+        if (instrcnt % TIME_CHECK == 0 and time.perf_counter() > deadline):
+            return "timeout", None, instrcnt
+        d = decode_cache.get(r[cpu1.PC]) or m.decode_at(r[cpu1.PC])
+        if (d is None):
+            return "halt", None, instrcnt
+        if (d.name == "ecall"):
+            return ("pass" if r[3] == 1 else "fail"), r[3], instrcnt
+        d.fn(m, d)
+        r[0] = 0
+        instrcnt += 1
+    return "limit", None, instrcnt
+
+
+def run_blocks(m, limit, deadline):
+    # ecall is always translated as a block of its own and never linked
+    # to, so it can only be reached through an unlinked exit; limit and
+    # timeout are checked between blocks
+    blocks = m.blocks = cpu1.BlockCache(m.decode_at)
+    r = m.regs
+    instrcnt = 0
+    checked = 0
+    b = prev = None
+    while instrcnt < limit:
+        if (instrcnt - checked >= TIME_CHECK):
+            checked = instrcnt
+            if (time.perf_counter() > deadline):
+                return "timeout", None, instrcnt
+        if (b is None):
+            d = m.decode_at(r[cpu1.PC])
+            if (d is None):
+                return "halt", None, instrcnt
+            if (d.name == "ecall"):
+                return ("pass" if r[3] == 1 else "fail"), r[3], instrcnt
+            b = blocks.get(r[cpu1.PC]) if prev is None else blocks.link(prev, r[cpu1.PC])
+        prev = b
+        b = b.fn(m, r)
+        instrcnt += prev.n
+    return "limit", None, instrcnt
+
+
+def run_test(path, limit, timeout, jit=False, cache=False):
+    result = {"name": os.path.basename(path), "path": path, "status": "error",
+              "gp": None, "instructions": 0, "seconds": 0.0, "error": None}
+    start = time.perf_counter()
+    try:
+        m = cpu1.Machine()
+        with open(path, 'rb') as f:
+            if (cache):
+                imagecache.load_elf(m, f)
+            else:
+                m.load_elf(f)
+        run = run_blocks if jit else run_insns
+        result["status"], result["gp"], result["instructions"] = run(m, limit, start + timeout)
+    except Exception as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def junit(results, seconds):
+    suite = ET.Element("testsuite", name="riscv-tests", tests=str(len(results)),
+                       failures=str(sum(r["status"] != "pass" and r["status"] != "error" for r in results)),
+                       errors=str(sum(r["status"] == "error" for r in results)),
+                       time="%.3f" % seconds)
+    for r in results:
+        case = ET.SubElement(suite, "testcase", classname="riscv-tests",
+                             name=r["name"], time="%.3f" % r["seconds"])
+        if (r["status"] == "error"):
+            ET.SubElement(case, "error", message=r["error"])
+        elif (r["status"] != "pass"):
+            msg = "%s after %d instructions" % (r["status"], r["instructions"])
+            if (r["gp"] is not None):
+                msg += " (gp=%d, test %d)" % (r["gp"], r["gp"] >> 1)
+            ET.SubElement(case, "failure", message=msg)
+    return ET.ElementTree(suite)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="run riscv-tests in parallel")
+    parser.add_argument("elf", nargs="*", help="test ELFs (default: rv32ui/rv32um suite)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--limit", type=int, default=1000000, help="instructions per test")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds per test")
+    parser.add_argument("--jit", action="store_true", help="use the block translator")
+    parser.add_argument("--cache", action="store_true", help="load through the image cache (imagecache.py)")
+    parser.add_argument("--json", help="write a JSON summary here")
+    parser.add_argument("--junit", help="write a JUnit XML summary here")
+    args = parser.parse_args()
+
+    paths = args.elf or [x for pattern in TESTS for x in glob.glob(pattern)]
+    paths = sorted(x for x in paths if not x.endswith('.dump'))
+
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [pool.submit(run_test, x, args.limit, args.timeout, args.jit, args.cache) for x in paths]
+        for future in as_completed(futures):
+            r = future.result()
+            results.append(r)
+            print("%-7s %-24s %10d instructions %8.3fs %s" % (
+                r["status"].upper(), r["name"], r["instructions"], r["seconds"], r["error"] or ""))
+    seconds = time.perf_counter() - start
+    results.sort(key=lambda r: r["name"])
+
+    passed = sum(r["status"] == "pass" for r in results)
+    print("%d/%d passed in %.2fs" % (passed, len(results), seconds))
+    if (args.json):
+        with open(args.json, "w") as f:
+            json.dump({"passed": passed, "total": len(results), "seconds": seconds,
+                       "tests": results}, f, indent=2)
+    if (args.junit):
+        junit(results, seconds).write(args.junit, encoding="utf-8", xml_declaration=True)
+    return 0 if passed == len(results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+
+# Machine snapshots: registers, counters, CSRs and memory. Taking one is
+# cheap, memory pages are shared copy-on-write between the machine and its
+# snapshots (see memory.py), and restoring the latest one only touches the
+# pages dirtied since. Any number of machines can be restored from the same
+# snapshot.
+#
+# save() writes a zlib stream of
+#
+#   header     magic, version, page count
+#   state      33 registers, instret, cycle/instret offsets, CSR count
+#   CSRs       (number, value) each
+#   pages      (page number, 4 KB of data) each, all-zero pages left out
+#
+# Mapped pages that were never touched are written out too, so a loaded
+# snapshot doesn't depend on the files it was mapped from.
+#
+#   ./snapshot.py     check that a machine survives save() and load()
+
+import io
+import struct
+import sys
+import zlib
+
+from memory import Page, PAGE_SHIFT, PAGE_SIZE, PAGE_MASK, materialize
+
+MAGIC = b"RVSN"
+VERSION = 1
+HEADER = struct.Struct("<4sII")
+STATE = struct.Struct("<33IQQQI")
+CSR = struct.Struct("<II")
+PAGE = struct.Struct("<I")
+ZERO = bytes(PAGE_SIZE)
+
+
+class Snapshot:
+    __slots__ = ("regs", "instret", "cycle_offset", "instret_offset", "csrs", "memory")
+
+    def __init__(self, regs, instret, cycle_offset, instret_offset, csrs, memory):
+        self.regs = regs
+        self.instret = instret
+        self.cycle_offset = cycle_offset
+        self.instret_offset = instret_offset
+        self.csrs = csrs
+        # Memory.snapshot(): (pages, regions)
+        self.memory = memory
+
+
+def save(s, f):
+    pages, regions = s.memory
+    pns = set(pages)
+    for start, size, data in regions:
+        pns.update(range(start >> PAGE_SHIFT, (start + size + PAGE_MASK) >> PAGE_SHIFT))
+    out = []
+    for pn in sorted(pns):
+        p = pages.get(pn) or materialize(regions, pn)
+        if (p is not None and p.data != ZERO):
+            out.append((pn, p.data))
+
+    z = zlib.compressobj()
+    f.write(z.compress(HEADER.pack(MAGIC, VERSION, len(out))))
+    f.write(z.compress(STATE.pack(*s.regs, s.instret, s.cycle_offset, s.instret_offset, len(s.csrs))))
+    for csr, value in sorted(s.csrs.items()):
+        f.write(z.compress(CSR.pack(csr, value)))
+    for pn, data in out:
+        f.write(z.compress(PAGE.pack(pn)))
+        f.write(z.compress(data))
+    f.write(z.flush())
+
+
+def load(f):
+    data = memoryview(zlib.decompress(f.read()))
+    magic, version, npages = HEADER.unpack_from(data, 0)
+    if (magic != MAGIC or version != VERSION):
+        raise Exception("not a snapshot file")
+    off = HEADER.size
+    state = STATE.unpack_from(data, off)
+    off += STATE.size
+    regs = list(state[:33])
+    instret, cycle_offset, instret_offset, ncsrs = state[33:]
+    csrs = {}
+    for _ in range(ncsrs):
+        csr, value = CSR.unpack_from(data, off)
+        csrs[csr] = value
+        off += CSR.size
+    pages = {}
+    for _ in range(npages):
+        pn, = PAGE.unpack_from(data, off)
+        off += PAGE.size
+        pages[pn] = Page(bytearray(data[off:off + PAGE_SIZE]))
+        off += PAGE_SIZE
+    return Snapshot(regs, instret, cycle_offset, instret_offset, csrs, (pages, []))
+
+
+def main():
+    # counters written to their extremes, a CSR and a dirty page through
+    # save() and load() into another machine
+    import asm
+    import cpu1
+    m = cpu1.Machine()
+    asm.load(m, """
+        li    t0, -1
+        csrw  0xb80, t0         # mcycleh, past a signed 64-bit offset
+        csrw  0xb02, zero       # minstret, below what has retired
+        csrw  0x340, t0         # mscratch
+        li    sp, 0x80001000
+        sw    t0, 4(sp)
+        addi  a0, a0, 1
+    """)
+    m.regs[cpu1.PC] = asm.BASE
+    m.run(100)
+    f = io.BytesIO()
+    save(m.snapshot(), f)
+    f.seek(0)
+    other = cpu1.Machine()
+    other.restore(load(f))
+    csrs = [0xB00, 0xB80, 0xB02, 0xB82, 0x340]
+    ok = (other.regs == m.regs and other.memory.read(0x80001000, 8) == m.memory.read(0x80001000, 8) and
+          [other.csr_read(c) for c in csrs] == [m.csr_read(c) for c in csrs])
+    print("round trip %s" % ("ok" if ok else "FAILED"))
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
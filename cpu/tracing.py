@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+
+# Structured execution trace. Off unless a Trace is attached to a machine;
+# then every instruction appends one fixed-size binary record
+#
+#   pc, instruction word, rd, value, memory address
+#
+# to a preallocated ring buffer, so long runs keep their most recent
+# records without any terminal I/O. value is the new rd for most
+# instructions and the stored value for stores; the address is 0 for
+# instructions that don't access memory. save() writes the records oldest
+# first, and running this file pretty-prints a saved trace:
+#
+#   ./tracing.py run.trace
+#   ./tracing.py --histogram run.trace
+#
+# A Histogram attached to a machine counts executed instructions by opcode
+# and by opcode/funct3 instead, which is cheap enough for whole runs.
+
+import struct
+import sys
+
+import isa
+from disasm import disasm, mnemonic
+from isa import regnames, LOADS, STORES
+
+RECORD = struct.Struct("<IIIII")
+HEADER = struct.Struct("<4sII")
+MAGIC = b"RVTR"
+
+
+class Trace:
+    def __init__(self, records=1 << 16):
+        self.size = records
+        self.buf = bytearray(RECORD.size * records)
+        # records appended so far; the ring holds the last self.size of them
+        self.count = 0
+
+    def append(self, pc, word, rd, value, addr):
+        RECORD.pack_into(self.buf, (self.count % self.size) * RECORD.size,
+                         pc, word, rd, value, addr)
+        self.count += 1
+
+    def records(self):
+        # oldest first
+        first = max(0, self.count - self.size)
+        for i in range(first, self.count):
+            yield RECORD.unpack_from(self.buf, (i % self.size) * RECORD.size)
+
+    def save(self, f):
+        n = min(self.count, self.size)
+        f.write(HEADER.pack(MAGIC, RECORD.size, n))
+        start = (self.count % self.size) * RECORD.size if self.count > self.size else 0
+        f.write(self.buf[start:n * RECORD.size])
+        f.write(self.buf[:start])
+
+
+NO_FUNCT3 = {spec["opcode"] for spec in isa.INSTR.values() if spec["type"] in ("U", "J")}
+
+
+class Histogram:
+    def __init__(self):
+        # indexed by opcode | funct3 << 7
+        self.counts = [0] * 0x400
+
+    def add(self, word):
+        self.counts[word & 0x7f | (word >> 5) & 0x380] += 1
+
+    def total(self):
+        return sum(self.counts)
+
+    def by_opcode(self):
+        # opcode -> count
+        out = {}
+        for i, n in enumerate(self.counts):
+            if (n):
+                out[i & 0x7f] = out.get(i & 0x7f, 0) + n
+        return out
+
+    def by_funct3(self):
+        # (opcode, funct3) -> count; U/J opcodes have no funct3, their
+        # counts are all under funct3 0
+        out = {}
+        for i, n in enumerate(self.counts):
+            if (n):
+                key = (i & 0x7f, 0 if i & 0x7f in NO_FUNCT3 else i >> 7)
+                out[key] = out.get(key, 0) + n
+        return out
+
+    def report(self):
+        total = self.total() or 1
+        lines = []
+        funct3s = self.by_funct3()
+        for opcode, n in sorted(self.by_opcode().items(), key=lambda x: -x[1]):
+            lines.append("%-20s %12d %6.2f%%" % (isa.OPCODES.get(opcode, "0x%02x" % opcode), n, 100.0 * n / total))
+            for (op, funct3), m in sorted(funct3s.items(), key=lambda x: -x[1]):
+                if (op != opcode):
+                    continue
+                names = "/".join(x for x, spec in isa.INSTR.items()
+                                 if spec["opcode"] == op and spec["funct3"] == funct3)
+                lines.append("  %-18s %12d %6.2f%%" % (names or "funct3=%d" % funct3, m, 100.0 * m / total))
+        return "\n".join(lines)
+
+
+def load(f):
+    magic, size, n = HEADER.unpack(f.read(HEADER.size))
+    if (magic != MAGIC or size != RECORD.size):
+        raise Exception("not a trace file")
+    data = f.read(n * RECORD.size)
+    return [RECORD.unpack_from(data, i * RECORD.size) for i in range(n)]
+
+
+def format_record(rec):
+    pc, word, rd, value, addr = rec
+    name = mnemonic(word)
+    line = "%08x  %08x  %-28s" % (pc, word, disasm(word, pc))
+    if (name in STORES):
+        line += " [%08x] <- %08x" % (addr, value)
+    elif (rd != 0):
+        line += " %3s = %08x" % (regnames[rd], value)
+        if (name in LOADS):
+            line += " <- [%08x]" % addr
+    return line.rstrip()
+
+
+def main():
+    histogram = "--histogram" in sys.argv[1:]
+    for path in sys.argv[1:]:
+        if (path.startswith("--")):
+            continue
+        with open(path, "rb") as f:
+            records = load(f)
+        if (histogram):
+            h = Histogram()
+            for rec in records:
+                h.add(rec[1])
+            print(h.report())
+            continue
+        for rec in records:
+            print(format_record(rec))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+
+# 16550-style UART for the memory bus (Memory.attach()). Registers are
+# bytes at offsets 0-7, as on the 16550 with a register shift of 0. The
+# transmitter is always ready; transmitted bytes collect in a buffer that
+# is written to the host file in bulk once it fills up, and on flush().
+# Received bytes are queued with feed(). Interrupts aren't modelled: IER
+# is stored but never raises anything.
+
+from collections import deque
+import sys
+
+# registers (offset)
+RBR, THR, DLL = 0, 0, 0
+IER, DLM = 1, 1
+IIR, FCR = 2, 2
+LCR, MCR, LSR, MSR, SCR = 3, 4, 5, 6, 7
+
+LCR_DLAB = 0x80
+MCR_LOOP = 0x10
+LSR_DR = 0x01
+LSR_THRE = 0x20
+LSR_TEMT = 0x40
+FCR_ENABLE = 0x01
+FCR_CLEAR_RX = 0x02
+FCR_CLEAR_TX = 0x04
+
+# host writes happen when this many bytes are buffered
+BUFFER = 4096
+
+
+class UART:
+    def __init__(self, out=None, buffer=BUFFER):
+        # out: binary file for transmitted bytes (default stdout)
+        self.out = out if out is not None else sys.stdout.buffer
+        self.buffer = buffer
+        self.tx = bytearray()
+        self.rx = deque()
+        self.regs = bytearray(8)
+        self.dll = 0
+        self.dlm = 0
+
+    def feed(self, data):
+        # bytes for the guest to receive
+        self.rx.extend(data)
+
+    def flush(self):
+        if (self.tx):
+            self.out.write(self.tx)
+            self.out.flush()
+            self.tx.clear()
+
+    def read(self, offset, size):
+        dlab = self.regs[LCR] & LCR_DLAB
+        if (offset == RBR):
+            if (dlab):
+                return self.dll
+            return self.rx.popleft() if self.rx else 0
+        if (offset == IER and dlab):
+            return self.dlm
+        if (offset == IIR):
+            # no interrupt pending; FIFOs enabled if FCR says so
+            return 0xC1 if self.regs[FCR] & FCR_ENABLE else 0x01
+        if (offset == LSR):
+            return LSR_THRE | LSR_TEMT | (LSR_DR if self.rx else 0)
+        if (offset < 8):
+            return self.regs[offset]
+        return 0
+
+    def write(self, offset, size, value):
+        value &= 0xFF
+        dlab = self.regs[LCR] & LCR_DLAB
+        if (offset == THR):
+            if (dlab):
+                self.dll = value
+            elif (self.regs[MCR] & MCR_LOOP):
+                self.rx.append(value)
+            else:
+                self.tx.append(value)
+                if (len(self.tx) >= self.buffer):
+                    self.flush()
+        elif (offset == IER and dlab):
+            self.dlm = value
+        elif (offset == FCR):
+            if (value & FCR_CLEAR_RX):
+                self.rx.clear()
+            if (value & FCR_CLEAR_TX):
+                self.flush()
+            self.regs[FCR] = value & FCR_ENABLE
+        elif (offset < 8 and offset != LSR):
+            self.regs[offset] = value